@@ -1,5 +1,7 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import base64
 import json
 import os
 import random
@@ -12,12 +14,17 @@ from typing import Any, cast
 from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.runnables import RunnableConfig
 from nc_py_api import AsyncNextcloudApp
-from nc_py_api.ex_app import persistent_storage
+from nc_py_api.ex_app import LogLvl, persistent_storage
 
 from ex_app.lib.all_tools.skills import list_skills_metadata
+from ex_app.lib.checkpoint_store import TOKEN_REF_PREFIX, get_conversation_store, pack_state, unpack_state
+from ex_app.lib.compaction import compact_history
 from ex_app.lib.graph import AgentState, get_graph
 from ex_app.lib.jsonplus import JsonPlusSerializer
+from ex_app.lib.logger import log
 from ex_app.lib.memorysaver import MemorySaver
+from ex_app.lib.message_store import get_message_store, join_messages, split_messages
+from ex_app.lib.metrics import CONVERSATION_TOKEN_BYTES, CONVERSATION_TOKEN_DECODE_SECONDS, ToolMetricsCallbackHandler
 from ex_app.lib.nc_model import (
 	MULTIMODAL_INTERACTION,
 	build_multimodal_content,
@@ -25,8 +32,12 @@ from ex_app.lib.nc_model import (
 	extract_text_content,
 	model,
 )
-from ex_app.lib.signature import add_signature, verify_signature
+from ex_app.lib.signature import sign, verify, verify_signature
+from ex_app.lib.stream_sender import StreamSender
+from ex_app.lib.tool_output_store import ToolOutputStore
+from ex_app.lib.tool_selection import ToolSelector
 from ex_app.lib.tools import get_tools
+from ex_app.lib.tracing import traced, tracing_callbacks
 
 # Dummy thread id as we return the whole state
 thread = {"configurable": {"thread_id": "thread-1"}}
@@ -34,48 +45,114 @@ thread = {"configurable": {"thread_id": "thread-1"}}
 key_file_path = persistent_storage() + '/secret_key.txt'
 
 if not os.path.exists(key_file_path):
-	with open(key_file_path, "w") as file:
-		# generate random string of 256 chars
-		random_string = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=256))
+	# generate random string of 256 chars
+	random_string = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=256))
+	# write to a temporary file and link it into place, so that worker processes starting
+	# at the same time all end up with the same key
+	tmp_key_file_path = f"{key_file_path}.{os.getpid()}.tmp"
+	with open(tmp_key_file_path, "w") as file:
 		file.write(random_string)
-	print(f"The file '{key_file_path}' has been created.")
+	try:
+		os.link(tmp_key_file_path, key_file_path)
+		print(f"The file '{key_file_path}' has been created.")
+	except FileExistsError:
+		pass
+	finally:
+		os.remove(tmp_key_file_path)
 
 with open(key_file_path, "r") as file:
 	print(f"Reading file '{key_file_path}'.")
 	key = file.read()
 
-def load_conversation_old(conversation_token: str):
+# prefix of the binary conversation tokens: base64url(HMAC) + '.' + base64url(zlib(msgpack(state)))
+TOKEN_V3_PREFIX = 'v3.'
+# same layout as v3, the messages are replaced by the hashes of the message store and the new messages
+TOKEN_V4_PREFIX = 'v4.'
+
+key_bytes = key.encode('utf-8')
+
+
+def _encode_state_v3(state: dict[str, Any], prefix: str = TOKEN_V3_PREFIX) -> str:
+	packed = pack_state(state)
+	signature = sign(packed, key_bytes)
+	return prefix + base64.urlsafe_b64encode(signature).decode('ascii') + '.' + base64.urlsafe_b64encode(packed).decode('ascii')
+
+
+def _decode_state_v3(conversation_token: str) -> dict[str, Any]:
+	# v4 tokens have a prefix of the same length
+	encoded_signature, _, encoded_state = conversation_token[len(TOKEN_V3_PREFIX):].partition('.')
+	packed = memoryview(base64.urlsafe_b64decode(encoded_state))
+	# Verify whether this was signed by this instance of context_agent
+	verify(packed, base64.urlsafe_b64decode(encoded_signature), key_bytes)
+	return unpack_state(packed)
+
+
+def _load_ref(conversation_token: str, checkpointer: MemorySaver, user_id: str | None) -> dict[str, Any]:
+	# the state is kept in the conversation store of this container
+	store = get_conversation_store(key)
+	if store is None:
+		raise Exception("Conversation token references a conversation store, but the store is disabled")
+	checkpointer.conversation_id, conversation = store.load(user_id or '', conversation_token)
+	return conversation
+
+
+def _load_v4(conversation_token: str, checkpointer: MemorySaver, user_id: str | None) -> dict[str, Any]:
+	return join_messages(_decode_state_v3(conversation_token), checkpointer.serde, get_message_store())
+
+
+def _load_v3(conversation_token: str, checkpointer: MemorySaver, user_id: str | None) -> dict[str, Any]:
+	return _decode_state_v3(conversation_token)
+
+
+def _load_legacy(conversation_token: str, checkpointer: MemorySaver, user_id: str | None) -> dict[str, Any] | None:
 	"""
-	Load a checkpointer with the conversation state from the conversation token
+	JSON tokens without a prefix
 
-	This is the old way which is only used as a fallback anymore
+	They either hold the last checkpoint or, in the old way, the whole checkpointer storage,
+	which is restored as it is and None is returned.
 	"""
-	checkpointer = MemorySaver()
-	if conversation_token == '' or conversation_token == '{}':
-		# return an empty checkpointer
-		return checkpointer
-	# Verify whether this conversation token was signed by this instance of context_agent
-	serialized_checkpointer = verify_signature(conversation_token, key)
-	# Deserialize the checkpointer storage
-	checkpointer.storage = checkpointer.serde.loads(serialized_checkpointer.encode())
-	# return the prepared checkpointer
-	return checkpointer
+	# Verify whether this was signed by this instance of context_agent
+	serialized_state = verify_signature(conversation_token, key)
+	# Deserialize the saved state
+	conversation = JsonPlusSerializer().loads(serialized_state.encode())
+	if 'last_checkpoint' in conversation:
+		return conversation
+	checkpointer.storage = conversation
+	return None
+
+
+TOKEN_LOADERS = {
+	TOKEN_REF_PREFIX: _load_ref,
+	TOKEN_V4_PREFIX: _load_v4,
+	TOKEN_V3_PREFIX: _load_v3,
+}
+# legacy tokens start with a hex signature, which never has a dot this early
+MAX_PREFIX_LENGTH = max(len(prefix) for prefix in TOKEN_LOADERS)
+
 
-def load_conversation(conversation_token: str):
+def load_conversation(conversation_token: str, user_id: str | None = None):
 	"""
 	Load a checkpointer with the conversation state from the conversation token
 
-	This is the new way which only restores that last checkpoint of the checkpointer instead of the whole checkpointer history
+	The prefix of the token selects its format, the signature is verified once.
 	"""
 	checkpointer = MemorySaver()
 	if conversation_token == '' or conversation_token == '{}':
 		# return an empty checkpointer
 		return checkpointer
 
-	# Verify whether this was signed by this instance of context_agent
-	serialized_state = verify_signature(conversation_token, key)
-	# Deserialize the saved state
-	conversation = JsonPlusSerializer().loads(serialized_state.encode())
+	prefix = conversation_token[:conversation_token.find('.', 0, MAX_PREFIX_LENGTH) + 1]
+	if not prefix:
+		loader = _load_legacy
+	elif prefix in TOKEN_LOADERS:
+		loader = TOKEN_LOADERS[prefix]
+	else:
+		raise Exception(f"Unknown conversation token format '{prefix}'")
+	started_at = monotonic()
+	conversation = loader(conversation_token, checkpointer, user_id)
+	CONVERSATION_TOKEN_DECODE_SECONDS.observe(monotonic() - started_at, format=prefix.rstrip('.') or 'legacy')
+	if conversation is None:
+		return checkpointer
 	# Get the last checkpoint state
 	last_checkpoint = conversation['last_checkpoint']
 	# get the last checkpointer config
@@ -85,7 +162,7 @@ def load_conversation(conversation_token: str):
 	# return the prepared checkpointer
 	return checkpointer
 
-def export_conversation(checkpointer):
+def export_conversation(checkpointer, user_id: str | None = None):
 	"""
 	Prepare and sign a conversation token from a checkpointer
 
@@ -97,27 +174,40 @@ def export_conversation(checkpointer):
 	last_checkpoint = checkpointer.storage[last_config['configurable']['thread_id']][last_config['configurable']['checkpoint_ns']][last_config['configurable']['checkpoint_id']]
 	# prepare the to-serialize blob
 	state = {"last_config": last_config, "last_checkpoint": last_checkpoint}
-	serialized_state = JsonPlusSerializer().dumps(state)
+	store = get_conversation_store(key)
+	if store is not None:
+		# only a signed reference to the stored state
+		checkpointer.conversation_id, conversation_token = store.save(user_id or '', checkpointer.conversation_id, state)
+		CONVERSATION_TOKEN_BYTES.observe(len(conversation_token))
+		return conversation_token
 	# sign the serialized state
-	conversation_token = add_signature(serialized_state.decode('utf-8'), key)
+	message_store = get_message_store()
+	if message_store is not None:
+		conversation_token = _encode_state_v3(split_messages(state, checkpointer.serde, message_store), TOKEN_V4_PREFIX)
+	else:
+		conversation_token = _encode_state_v3(state)
+	CONVERSATION_TOKEN_BYTES.observe(len(conversation_token))
 	return conversation_token
 
+@traced("react")
 async def react(
 		task,
 		nc: AsyncNextcloudApp,
 		stream_output: Callable[[dict[str, Any]], Awaitable[None]] | None = None,
 ):
 	multimodal = task.get('type') == MULTIMODAL_INTERACTION
-	model.bind_nextcloud(nc)
-	model.multimodal = multimodal
-
 	safe_tools, dangerous_tools = await get_tools(nc)
+	task_model = model.bind_nextcloud(nc, multimodal=multimodal).model_copy(update={
+		"cache_bypass_tools": frozenset(tool.name for tool in dangerous_tools),
+	})
+	# large tool outputs are kept out of the history, the model can read them with this store's tool
+	user_id = await nc.user
+	tool_output_store = ToolOutputStore(user_id)
+	safe_tools = safe_tools + tool_output_store.get_tools()
 
 	tools = dangerous_tools + safe_tools
-
-	bound_model = model.bind_tools(
-		tools,
-	)
+	# only the tools relevant to the current turn are sent to the model
+	tool_selector = ToolSelector(tools, always=[tool.name for tool in tool_output_store.get_tools()])
 
 	def tool_enabled(tool_name):
 		for tool in tools:
@@ -181,24 +271,35 @@ At the end of each message to the user, if you have carried out a task or answer
 					" or when they describe a clearly reusable procedure that should be remembered.\n"
 				)
 
+		messages = state["messages"]
+		summary = state.get("summary", "")
+		update = {}
+		try:
+			update = await compact_history(task_model, messages, summary) or {}
+		except Exception as e:
+			# the history limit of the model still applies
+			await log(nc, LogLvl.WARNING, f"Failed to compact the conversation history: {e}")
+		if update:
+			removed_ids = {message.id for message in update["messages"]}
+			messages = [message for message in messages if message.id not in removed_ids]
+			summary = update["summary"]
+		if summary:
+			system_prompt_text += "Earlier parts of this conversation are no longer shown, this is a summary of them:\n\n" + summary + "\n"
+
 		# this is similar to customizing the create_react_agent with state_modifier, but is a lot more flexible
 		system_prompt = SystemMessage(
 			system_prompt_text.replace("{CURRENT_DATE}", current_date)
 		)
 
-		response = await bound_model.ainvoke([system_prompt] + state["messages"], config)
+		bound_model = task_model.bind_tools(tool_selector.select(messages))
+		response = await bound_model.ainvoke([system_prompt] + list(messages), config)
 		# We return a list, because this will get added to the existing list
-		return {"messages": [response]}
+		return {**update, "messages": [*update.get("messages", []), response]}
 
-	try:
-		# Try to load state using the new conversation_token type
-		checkpointer = load_conversation(task['input']['conversation_token'])
-	except Exception as e:
-		# fallback to trying to load the state using the old conversation_token type
-		# if this fails, we fail the whole task
-		checkpointer = load_conversation_old(task['input']['conversation_token'])
+	# if this fails, we fail the whole task
+	checkpointer = await asyncio.to_thread(load_conversation, task['input']['conversation_token'], user_id)
 
-	graph = await get_graph(call_model, safe_tools, dangerous_tools, checkpointer)
+	graph = await get_graph(call_model, safe_tools, dangerous_tools, checkpointer, tool_output_store.offload_messages)
 
 	state_snapshot = graph.get_state(thread)
 
@@ -229,58 +330,60 @@ At the end of each message to the user, if you have carried out a task or answer
 	last_message: AIMessage = AIMessage("")
 	if len(snapshot_messages) > 0:
 		last_message = cast(AIMessage, snapshot_messages[-1])
-	previous_message_count = len(snapshot_messages)
+	# ids instead of a count, as compacting the history removes messages
+	seen_message_ids = {message.id for message in snapshot_messages}
 	source_list: list[str] = []
 	known_sources: set[str] = set()
 	streamed_output = ''
-	last_stream_update = 0.0
-	last_reported_stream_state: dict[str, Any] | None = None
 	prefer_streaming = bool(task.get('preferStreaming'))
 	stream_mode = ["messages", "values"] if prefer_streaming and stream_output is not None else "values"
+	# sends the updates in the background, so slow responses don't hold up the graph
+	stream_sender = StreamSender(stream_output) if stream_output is not None else None
 
-	async def report_stream_state(force: bool = False):
-		nonlocal last_stream_update
-		nonlocal last_reported_stream_state
-		if stream_output is None:
-			return
-		stream_state = {'output': streamed_output, 'sources': json.dumps(source_list.copy())}
-		if last_reported_stream_state == stream_state:
+	def report_stream_state(urgent: bool = False):
+		if stream_sender is None:
 			return
-		now = monotonic()
-		if not force and last_reported_stream_state is not None and (now - last_stream_update) < 0.5:
-			return
-		await stream_output(stream_state)
-		last_stream_update = now
-		last_reported_stream_state = stream_state
-
-	async for event in graph.astream(new_input, thread, stream_mode=stream_mode):
-		if isinstance(event, tuple):
-			mode, payload = event
-		else:
-			mode, payload = "values", event
+		stream_sender.update({'output': streamed_output, 'sources': json.dumps(source_list)}, urgent=urgent)
 
-		if mode == 'messages':
-			message_chunk, metadata = payload
-			if metadata.get('langgraph_node') != 'agent' or not isinstance(message_chunk, AIMessageChunk):
+	config = {**thread, "callbacks": [ToolMetricsCallbackHandler(), *tracing_callbacks()]}
+	try:
+		async for event in graph.astream(new_input, config, stream_mode=stream_mode):
+			if isinstance(event, tuple):
+				mode, payload = event
+			else:
+				mode, payload = "values", event
+
+			if mode == 'messages':
+				message_chunk, metadata = payload
+				if metadata.get('langgraph_node') != 'agent' or not isinstance(message_chunk, AIMessageChunk):
+					continue
+				chunk_content = message_chunk.content
+				if isinstance(chunk_content, str) and chunk_content != '':
+					streamed_output += chunk_content
+					report_stream_state()
 				continue
-			chunk_content = message_chunk.content
-			if isinstance(chunk_content, str) and chunk_content != '':
-				streamed_output += chunk_content
-				await report_stream_state()
-			continue
-
-		event = payload
-		last_message = event['messages'][-1]
-		for message in event['messages'][previous_message_count:]:
-			if isinstance(message, AIMessage) and message.tool_calls:
-					for tool_call in message.tool_calls:
-						tool_name = tool_call['name']
-						if tool_name not in known_sources:
-							known_sources.add(tool_name)
-							source_list.append(tool_name)
-							await report_stream_state(force=True)
-
-	await report_stream_state(force=True)
+
+			event = payload
+			last_message = event['messages'][-1]
+			for message in event['messages']:
+				if message.id in seen_message_ids:
+					continue
+				seen_message_ids.add(message.id)
+				if isinstance(message, AIMessage) and message.tool_calls:
+						for tool_call in message.tool_calls:
+							tool_name = tool_call['name']
+							if tool_name not in known_sources:
+								known_sources.add(tool_name)
+								source_list.append(tool_name)
+								report_stream_state(urgent=True)
+	except BaseException:
+		if stream_sender is not None:
+			stream_sender.cancel()
+		raise
+
+	if stream_sender is not None:
+		report_stream_state(urgent=True)
+		await stream_sender.close()
 
 	state_snapshot = graph.get_state(thread)
 	actions = ''
@@ -290,7 +393,7 @@ At the end of each message to the user, if you have carried out a task or answer
 	result = {
 		'output': extract_text_content(last_message.content),
 		'actions': actions,
-		'conversation_token': export_conversation(checkpointer),
+		'conversation_token': await asyncio.to_thread(export_conversation, checkpointer, user_id),
 		'sources': source_list,
 	}
 	if multimodal:
@@ -1,7 +1,6 @@
 # SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import asyncio
-import time
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
@@ -14,6 +13,7 @@ import xml.etree.ElementTree as ET
 import vobject
 
 from ex_app.lib.all_tools.lib.decorator import safe_tool, dangerous_tool
+from ex_app.lib.all_tools.lib.retry import CircuitOpenError, retry_ocs_sync
 from ex_app.lib.all_tools.lib.freebusy_finder import find_available_slots, round_to_nearest_half_hour
 
 
@@ -72,21 +72,14 @@ async def get_tools(nc: AsyncNextcloudApp):
 				e.add_attendee(Attendee(common_name=attendee, email=attendee, partstat='NEEDS-ACTION', role='REQ-PARTICIPANT', cutype='INDIVIDUAL'))
 
 		# let's check who we are...
-		i = 0
-		while i < 20:
-			try:
-				json = ncSync.ocs('GET', '/ocs/v2.php/cloud/user')
-				break
-			except (
-					ConnectionError,
-					Timeout
-			) as e:
-				i += 1
-				time.sleep(1)
-				continue
-
-		if i >= 20:
-			raise Exception('Error fetching current user information')
+		try:
+			json = retry_ocs_sync(lambda: ncSync.ocs('GET', '/ocs/v2.php/cloud/user'))
+		except (
+				ConnectionError,
+				Timeout,
+				CircuitOpenError,
+		) as e:
+			raise Exception('Error fetching current user information') from e
 
 		# ...and set the organizer
 		e.organizer = Organizer(common_name=json['displayname'], email=json['email'])
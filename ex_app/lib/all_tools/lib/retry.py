@@ -0,0 +1,219 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import random
+import threading
+import time
+import typing
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+
+from nc_py_api import NextcloudException
+from niquests import ConnectionError, ConnectTimeout, Timeout
+from niquests.packages.urllib3.exceptions import NewConnectionError
+
+T = typing.TypeVar("T")
+
+# status codes after which a request is worth repeating
+RETRY_STATUS_CODES = (408, 429, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+	"""Nextcloud failed repeatedly, requests are not sent until it has had time to recover"""
+
+
+class CircuitBreaker:
+	"""
+	Process-wide view of whether Nextcloud currently accepts requests
+
+	After `failure_threshold` failures in a row the circuit opens and requests fail right away.
+	Once `reset_timeout` has passed, one request is let through: if it succeeds the circuit closes,
+	otherwise it stays open for twice as long, up to `max_reset_timeout`.
+	"""
+
+	def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10, max_reset_timeout: float = 120):
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.max_reset_timeout = max_reset_timeout
+		self.failures = 0
+		self.open_timeout = reset_timeout
+		self.open_until = 0.0
+		self.probing = False
+		# used from tool threads as well
+		self._lock = threading.Lock()
+
+	@property
+	def is_open(self) -> bool:
+		return self.failures >= self.failure_threshold
+
+	def before_call(self) -> bool:
+		"""
+		:return: Whether this call is the probe of an open circuit
+		:raises CircuitOpenError: While the circuit is open
+		"""
+		with self._lock:
+			if not self.is_open:
+				return False
+			if time.monotonic() < self.open_until or self.probing:
+				raise CircuitOpenError("Nextcloud is currently overloaded or unreachable, please try again later")
+			self.probing = True
+			return True
+
+	def cancel_probe(self):
+		"""The probe was cancelled before it got an answer, the next call probes instead"""
+		with self._lock:
+			self.probing = False
+
+	def record_success(self):
+		with self._lock:
+			self.failures = 0
+			self.open_timeout = self.reset_timeout
+			self.probing = False
+
+	def record_failure(self, retry_after: float | None = None):
+		with self._lock:
+			if self.probing:
+				self.open_timeout = min(self.open_timeout * 2, self.max_reset_timeout)
+			self.failures += 1
+			self.probing = False
+			if self.is_open:
+				self.open_until = time.monotonic() + max(self.open_timeout, retry_after or 0)
+
+
+class RetryPolicy:
+	"""
+	Exponential backoff with full jitter, honoring the Retry-After header of Nextcloud
+
+	Requests that are not idempotent, like sending an email or scheduling a task, are only repeated
+	when they certainly had no effect: the connection couldn't be opened, or Nextcloud rejected
+	them with 429. A timeout or a 5xx answer may come after the request was carried out.
+	"""
+
+	def __init__(self, attempts: int = 8, base_delay: float = 0.5, max_delay: float = 30, idempotent: bool = True):
+		self.attempts = attempts
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.idempotent = idempotent
+
+	def should_retry(self, error: Exception) -> bool:
+		if self.idempotent:
+			return is_retryable(error)
+		if isinstance(error, NextcloudException):
+			return error.status_code == 429
+		return is_unsent(error)
+
+	def delay(self, attempt: int, error: Exception) -> float:
+		delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+		retry_after = retry_after_seconds(error)
+		if retry_after is not None:
+			delay = max(delay, min(retry_after, self.max_delay))
+		return delay
+
+
+nextcloud_circuit = CircuitBreaker()
+DEFAULT_RETRY_POLICY = RetryPolicy()
+NON_IDEMPOTENT_RETRY_POLICY = RetryPolicy(idempotent=False)
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+	"""The wait time requested by the Retry-After header of a failed response"""
+	response = getattr(error, "response", None)
+	headers = getattr(response, "headers", None)
+	value = headers.get("Retry-After") if headers else None
+	if not value:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+
+def is_retryable(error: Exception) -> bool:
+	if isinstance(error, (ConnectionError, Timeout)):
+		return True
+	return isinstance(error, NextcloudException) and error.status_code in RETRY_STATUS_CODES
+
+
+def is_unsent(error: Exception) -> bool:
+	"""Whether the request failed before it reached the server"""
+	if isinstance(error, ConnectTimeout):
+		return True
+	if not isinstance(error, ConnectionError) or not error.args:
+		return False
+	return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+
+
+def _before_call(circuit: CircuitBreaker | None) -> bool:
+	return circuit is not None and circuit.before_call()
+
+
+def _after_call(circuit: CircuitBreaker | None, error: Exception | None):
+	if circuit is None:
+		return
+	if error is None or not is_retryable(error):
+		# the server answered, even if with an error
+		circuit.record_success()
+	else:
+		circuit.record_failure(retry_after_seconds(error))
+
+
+async def retry_ocs(
+		call: Callable[[], Awaitable[T]],
+		policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+		circuit: CircuitBreaker | None = nextcloud_circuit,
+) -> T:
+	"""
+	Run a request to Nextcloud, repeating it on connection errors, timeouts, 429 and 5xx answers
+	as far as the policy allows
+
+	:raises CircuitOpenError: While Nextcloud is considered overloaded
+	:raises Exception: The error of the last attempt, or any error that is not worth a retry
+	"""
+	for attempt in range(policy.attempts):
+		probe = _before_call(circuit)
+		try:
+			result = await call()
+		except Exception as e:
+			_after_call(circuit, e)
+			if not policy.should_retry(e) or attempt == policy.attempts - 1:
+				raise
+			await asyncio.sleep(policy.delay(attempt, e))
+			continue
+		except BaseException:
+			# cancelled, the outcome is unknown and must not keep the circuit blocked
+			if probe:
+				circuit.cancel_probe()
+			raise
+		_after_call(circuit, None)
+		return result
+	raise RuntimeError("The retry policy allows no attempts")
+
+
+def retry_ocs_sync(
+		call: Callable[[], T],
+		policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+		circuit: CircuitBreaker | None = nextcloud_circuit,
+) -> T:
+	"""Like retry_ocs, for the synchronous client used in tool threads"""
+	for attempt in range(policy.attempts):
+		probe = _before_call(circuit)
+		try:
+			result = call()
+		except Exception as e:
+			_after_call(circuit, e)
+			if not policy.should_retry(e) or attempt == policy.attempts - 1:
+				raise
+			time.sleep(policy.delay(attempt, e))
+			continue
+		except BaseException:
+			# cancelled, the outcome is unknown and must not keep the circuit blocked
+			if probe:
+				circuit.cancel_probe()
+			raise
+		_after_call(circuit, None)
+		return result
+	raise RuntimeError("The retry policy allows no attempts")
@@ -1,20 +1,32 @@
 # SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import asyncio
+import heapq
+import itertools
 import typing
+from contextvars import ContextVar
+from time import monotonic, time
 
 from nc_py_api import AsyncNextcloudApp, NextcloudException
 from nc_py_api.ex_app import LogLvl
 from niquests import ConnectionError, Timeout
 from pydantic import BaseModel, ValidationError
 
+from ex_app.lib.all_tools.lib.retry import (
+	CircuitOpenError,
+	NON_IDEMPOTENT_RETRY_POLICY,
+	retry_after_seconds,
+	retry_ocs,
+)
 from ex_app.lib.logger import log
+from ex_app.lib.tracing import traced
 
 
 class Task(BaseModel):
 	id: int
 	status: str
 	output: dict[str, typing.Any] | None = None
+	completionExpectedAt: int | None = None
 
 class Response(BaseModel):
 	task: Task
@@ -22,60 +34,198 @@ class Response(BaseModel):
 
 ACCEPTED_OUTPUT_KEYS = ["file", "output", "images", "slide_deck", "sources"]
 
+# ids of the unfinished TaskProcessing tasks scheduled on behalf of the current agent task
+scheduled_task_ids: ContextVar[set[int] | None] = ContextVar("scheduled_task_ids", default=None)
 
-async def run_task(nc: AsyncNextcloudApp, type, task_input):
-	i = 0
-	while i < 20:
+
+def track_scheduled_task(task_id: int):
+	task_ids = scheduled_task_ids.get()
+	if task_ids is not None:
+		task_ids.add(task_id)
+
+
+def untrack_scheduled_task(task_id: int):
+	task_ids = scheduled_task_ids.get()
+	if task_ids is not None:
+		task_ids.discard(task_id)
+
+
+class PollSchedule:
+	"""
+	Wait times between the polls of a TaskProcessing task
+
+	Starts at `initial` seconds and grows by `factor` up to `cap`, so that fast backends are
+	picked up quickly. While Nextcloud expects the task (based on the provider's expected runtime)
+	to take longer, the wait stretches towards that time, still bounded by `cap`.
+	"""
+
+	def __init__(self, initial: float, cap: float, factor: float = 1.5):
+		self.interval = min(initial, cap)
+		self.cap = cap
+		self.factor = factor
+
+	def next_interval(self, completion_expected_at: int | None = None) -> float:
+		interval = self.interval
+		self.interval = min(self.interval * self.factor, self.cap)
+		if completion_expected_at:
+			remaining = completion_expected_at - time()
+			if remaining > interval:
+				interval = min(remaining, self.cap)
+		return interval
+
+
+class TaskPoller:
+	"""
+	Polls all outstanding TaskProcessing tasks of this process from a single loop
+
+	Callers ask for the next status of a task after some delay and await it. All polls share
+	one concurrency limit and one rate limit state: when Nextcloud answers with 429, every
+	pending poll is held back with exponential backoff, instead of each caller retrying on its own.
+	"""
+
+	def __init__(self, max_concurrent_polls: int = 10, min_backoff: float = 2, max_backoff: float = 60):
+		self.max_concurrent_polls = max_concurrent_polls
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.backoff = 0.0
+		self.backoff_until = 0.0
+		self._due: list[tuple[float, int, AsyncNextcloudApp, int, asyncio.Future]] = []
+		self._counter = itertools.count()
+		self._wakeup: asyncio.Event | None = None
+		self._runner: asyncio.Task | None = None
+		self._semaphore: asyncio.Semaphore | None = None
+		self._polls: set[asyncio.Task] = set()
+
+	@property
+	def outstanding(self) -> int:
+		return len(self._due) + len(self._polls)
+
+	async def poll(self, nc: AsyncNextcloudApp, task_id: int, delay: float) -> dict[str, typing.Any]:
+		"""
+		Fetch the task from Nextcloud after `delay` seconds, or later while rate limited
+
+		:return: The OCS response of /taskprocessing/task/{task_id}
+		"""
+		if self._runner is None or self._runner.done():
+			self._wakeup = asyncio.Event()
+			self._semaphore = asyncio.Semaphore(self.max_concurrent_polls)
+			self._runner = asyncio.create_task(self._run())
+		future = asyncio.get_running_loop().create_future()
+		self._schedule(monotonic() + delay, nc, task_id, future)
+		return await future
+
+	def _schedule(self, due: float, nc: AsyncNextcloudApp, task_id: int, future: asyncio.Future):
+		heapq.heappush(self._due, (due, next(self._counter), nc, task_id, future))
+		self._wakeup.set()
+
+	async def _run(self):
+		while True:
+			self._wakeup.clear()
+			now = monotonic()
+			if not self._due:
+				await self._wakeup.wait()
+				continue
+			next_due = max(self._due[0][0], self.backoff_until)
+			if next_due > now:
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), timeout=next_due - now)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			while self._due and self._due[0][0] <= now:
+				_, _, nc, task_id, future = heapq.heappop(self._due)
+				if future.done():
+					# the caller is gone
+					continue
+				poll = asyncio.create_task(self._poll(nc, task_id, future))
+				self._polls.add(poll)
+				poll.add_done_callback(self._polls.discard)
+
+	async def _poll(self, nc: AsyncNextcloudApp, task_id: int, future: asyncio.Future):
+		async with self._semaphore:
+			if future.done():
+				return
+			if monotonic() < self.backoff_until:
+				self._schedule(self.backoff_until, nc, task_id, future)
+				return
+			try:
+				response = await nc.ocs("GET", f"/ocs/v1.php/taskprocessing/task/{task_id}")
+			except NextcloudException as e:
+				if e.status_code == 429:
+					self._rate_limited(retry_after_seconds(e))
+					await log(nc, LogLvl.INFO, f"Rate limited during task polling, holding back all polls for {self.backoff:.0f}s")
+					self._schedule(self.backoff_until, nc, task_id, future)
+					return
+				if not future.done():
+					future.set_exception(e)
+				return
+			except Exception as e:
+				if not future.done():
+					future.set_exception(e)
+				return
+			self.backoff = 0.0
+			if not future.done():
+				future.set_result(response)
+
+	def _rate_limited(self, retry_after: float | None = None):
+		self.backoff = min(max(self.backoff * 2, self.min_backoff, retry_after or 0), self.max_backoff)
+		self.backoff_until = max(self.backoff_until, monotonic() + self.backoff)
+
+
+task_poller = TaskPoller()
+
+
+async def cancel_tasks(nc: AsyncNextcloudApp, task_ids: typing.Iterable[int]):
+	"""Cancel TaskProcessing tasks, so that they don't occupy the backend anymore"""
+	for task_id in list(task_ids):
 		try:
-			response = await nc.ocs(
-				"POST",
-				"/ocs/v1.php/taskprocessing/schedule",
-				json={"type": type, "appId": "context_agent", "input": task_input},
-			)
-			break
-		except (
-				ConnectionError,
-				Timeout
-
-		) as e:
-			await log(nc, LogLvl.DEBUG, "Ignored error during task scheduling")
-			i += 1
-			await asyncio.sleep(1)
-			continue
-
-	if i >= 20:
-		raise Exception("Failed to schedule task")
+			await nc.ocs("POST", f"/ocs/v2.php/taskprocessing/tasks/{task_id}/cancel")
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			await log(nc, LogLvl.DEBUG, f"Failed to cancel task {task_id}: {e}")
+
+
+@traced("task_processing.run_task")
+async def run_task(nc: AsyncNextcloudApp, type, task_input):
+	try:
+		response = await retry_ocs(lambda: nc.ocs(
+			"POST",
+			"/ocs/v1.php/taskprocessing/schedule",
+			json={"type": type, "appId": "context_agent", "input": task_input},
+		), NON_IDEMPOTENT_RETRY_POLICY)
+	except (
+			ConnectionError,
+			Timeout,
+			CircuitOpenError,
+	) as e:
+		raise Exception("Failed to schedule task") from e
 
 	try:
 		task = Response.model_validate(response).task
 		await log(nc, LogLvl.DEBUG, task)
+		track_scheduled_task(task.id)
 
-		i = 0
-		# wait for 5 seconds * 60 * 2 = 10 minutes (one i ^= 5 sec)
-		while task.status != "STATUS_SUCCESSFUL" and task.status != "STATUS_FAILED" and i < 60 * 2:
-			await asyncio.sleep(5)
-			i += 1
+		schedule = PollSchedule(0.5, 5)
+		# wait for 10 minutes
+		deadline = monotonic() + 10 * 60
+		while task.status != "STATUS_SUCCESSFUL" and task.status != "STATUS_FAILED" and monotonic() < deadline:
 			try:
-				response = await nc.ocs("GET", f"/ocs/v1.php/taskprocessing/task/{task.id}")
+				response = await task_poller.poll(nc, task.id, schedule.next_interval(task.completionExpectedAt))
 			except (
 					ConnectionError,
 					Timeout
 			) as e:
 				await log(nc, LogLvl.DEBUG, "Ignored error during task polling")
-				await asyncio.sleep(5)
-				i += 1
 				continue
 			except NextcloudException as e:
-				if e.status_code == 429:
-					await log(nc, LogLvl.INFO, "Rate limited during task polling, waiting 10s more")
-					await asyncio.sleep(10)
-					i += 2
-					continue
 				raise Exception("Nextcloud error when polling task") from e
 			task = Response.model_validate(response).task
 			await log(nc, LogLvl.DEBUG, task)
 	except ValidationError as e:
 		raise Exception("Failed to parse Nextcloud TaskProcessing task result") from e
+	if task.status in ("STATUS_SUCCESSFUL", "STATUS_FAILED"):
+		untrack_scheduled_task(task.id)
 	if task.status != "STATUS_SUCCESSFUL":
 		raise Exception("Nextcloud TaskProcessing Task failed")
 
@@ -1,14 +1,11 @@
 # SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
-from asyncio import sleep
-
 from niquests import ConnectionError, Timeout
 from langchain_core.tools import tool
 from nc_py_api import AsyncNextcloudApp
-from nc_py_api.ex_app import LogLvl
 
 from ex_app.lib.all_tools.lib.decorator import safe_tool, dangerous_tool
-from ex_app.lib.logger import log
+from ex_app.lib.all_tools.lib.retry import CircuitOpenError, NON_IDEMPOTENT_RETRY_POLICY, retry_ocs
 
 
 async def get_tools(nc: AsyncNextcloudApp):
@@ -22,27 +19,22 @@ async def get_tools(nc: AsyncNextcloudApp):
 		:param account_id: The id of the account to send from, obtainable via get_mail_account_list
 		:param to_emails: The email addresses to send the message to
 		"""
-		i = 0
 		body_with_ai_note = f"{body}\n\n---\n\nThis email was sent by Nextcloud AI Assistant."
-		while i < 20:
-			try:
-				return await nc.ocs('POST', '/ocs/v2.php/apps/mail/message/send', json={
-					'accountId': account_id,
-					'fromEmail': from_email,
-					'subject': subject,
-					'body': body_with_ai_note,
-					'isHtml': False,
-					'to': [{'label': '', 'email': email} for email in to_emails],
-				})
-			except (
-					ConnectionError,
-					Timeout
-			) as e:
-				await log(nc, LogLvl.DEBUG, "Ignored error during task polling")
-				i += 1
-				await sleep(1)
-				continue
-		raise Exception("Failed to send email")
+		try:
+			return await retry_ocs(lambda: nc.ocs('POST', '/ocs/v2.php/apps/mail/message/send', json={
+				'accountId': account_id,
+				'fromEmail': from_email,
+				'subject': subject,
+				'body': body_with_ai_note,
+				'isHtml': False,
+				'to': [{'label': '', 'email': email} for email in to_emails],
+			}), NON_IDEMPOTENT_RETRY_POLICY)
+		except (
+				ConnectionError,
+				Timeout,
+				CircuitOpenError,
+		) as e:
+			raise Exception("Failed to send email") from e
 
 	@tool
 	@safe_tool
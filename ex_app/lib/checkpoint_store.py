@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Any
+
+import ormsgpack
+from nc_py_api.ex_app import persistent_storage
+
+from ex_app.lib.signature import sign, verify
+
+# "token" keeps the whole conversation state in the conversation token,
+# "sqlite" keeps it in this container and the token only references it
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "token")
+# stored conversation states older than this many days are removed
+CONVERSATION_MAX_AGE_DAYS = int(os.getenv("CONVERSATION_MAX_AGE_DAYS", "90"))
+GC_INTERVAL = 60 * 60
+# newest states kept per conversation, older tokens of the conversation stay usable e.g. to regenerate an answer
+KEPT_CHECKPOINTS = 3
+
+# prefix of the reference tokens: conversation id, checkpoint id and HMAC, separated by dots
+TOKEN_REF_PREFIX = 'ref1.'
+
+
+def pack_state(state: dict[str, Any]) -> bytes:
+	# the checkpoint is already serialized to bytes, which msgpack keeps as they are
+	return zlib.compress(ormsgpack.packb(state), 6)
+
+
+def unpack_state(packed: bytes) -> dict[str, Any]:
+	return ormsgpack.unpackb(zlib.decompress(packed))
+
+
+class ConversationStore:
+	"""
+	Last checkpoints of the conversations, in SQLite in the persistent storage
+
+	The graph still runs on an in-memory checkpointer, this store replaces carrying its last
+	checkpoint in the conversation token: the token only names the stored state. Only the
+	newest KEPT_CHECKPOINTS states of a conversation are kept.
+	"""
+
+	def __init__(self, path: str, key: str):
+		self.path = path
+		self.key = key.encode()
+		self.last_gc = 0.0
+		self._local = threading.local()
+		with self._connection() as connection:
+			connection.execute("""
+				CREATE TABLE IF NOT EXISTS checkpoints (
+					conversation_id TEXT NOT NULL,
+					checkpoint_id TEXT NOT NULL,
+					user_id TEXT NOT NULL,
+					state BLOB NOT NULL,
+					created_at REAL NOT NULL,
+					PRIMARY KEY (conversation_id, checkpoint_id)
+				)
+			""")
+			connection.execute("CREATE INDEX IF NOT EXISTS checkpoints_created_at ON checkpoints (created_at)")
+
+	def _connection(self) -> sqlite3.Connection:
+		# one connection per thread, the store is used from worker threads
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.path, timeout=30)
+			# several worker processes may share the database
+			connection.execute("PRAGMA journal_mode=WAL")
+			self._local.connection = connection
+		return connection
+
+	def save(self, user_id: str, conversation_id: str | None, state: dict[str, Any]) -> tuple[str, str]:
+		"""
+		Store the state of a conversation
+
+		:param conversation_id: The id of the conversation, None for a new one
+		:return: The conversation id and the reference token
+		"""
+		conversation_id = conversation_id or uuid.uuid4().hex
+		checkpoint_id = state['last_config']['configurable']['checkpoint_id']
+		with self._connection() as connection:
+			connection.execute(
+				"INSERT OR REPLACE INTO checkpoints (conversation_id, checkpoint_id, user_id, state, created_at) VALUES (?, ?, ?, ?, ?)",
+				(conversation_id, checkpoint_id, user_id, pack_state(state), time.time()),
+			)
+			connection.execute(
+				"""
+				DELETE FROM checkpoints WHERE conversation_id = ? AND checkpoint_id NOT IN (
+					SELECT checkpoint_id FROM checkpoints WHERE conversation_id = ? ORDER BY created_at DESC LIMIT ?
+				)
+				""",
+				(conversation_id, conversation_id, KEPT_CHECKPOINTS),
+			)
+		self._collect_garbage()
+		reference = f"{conversation_id}.{checkpoint_id}"
+		return conversation_id, TOKEN_REF_PREFIX + reference + '.' + sign(reference.encode(), self.key).hex()
+
+	def load(self, user_id: str, token: str) -> tuple[str, dict[str, Any]]:
+		"""
+		Look up the state a reference token points to
+
+		:return: The conversation id and the state
+		"""
+		reference, _, signature = token[len(TOKEN_REF_PREFIX):].rpartition('.')
+		try:
+			signature_bytes = bytes.fromhex(signature)
+		except ValueError:
+			raise Exception("Signature verification failed")
+		verify(reference.encode(), signature_bytes, self.key)
+		conversation_id, _, checkpoint_id = reference.partition('.')
+		row = self._connection().execute(
+			"SELECT state FROM checkpoints WHERE conversation_id = ? AND checkpoint_id = ? AND user_id = ?",
+			(conversation_id, checkpoint_id, user_id),
+		).fetchone()
+		if row is None:
+			raise Exception("The conversation has expired or was stored on another instance")
+		return conversation_id, unpack_state(row[0])
+
+	def _collect_garbage(self):
+		now = time.time()
+		if now - self.last_gc < GC_INTERVAL:
+			return
+		self.last_gc = now
+		with self._connection() as connection:
+			connection.execute("DELETE FROM checkpoints WHERE created_at < ?", (now - CONVERSATION_MAX_AGE_DAYS * 24 * 60 * 60,))
+
+
+_store: ConversationStore | None = None
+
+
+def get_conversation_store(key: str) -> ConversationStore | None:
+	"""The store of this container, None when the state is kept in the tokens"""
+	global _store
+	if CONVERSATION_STORE != 'sqlite':
+		return None
+	if _store is None:
+		_store = ConversationStore(os.path.join(persistent_storage(), 'conversations.sqlite3'), key)
+	return _store
@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+import os
+from collections.abc import Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage, RemoveMessage, SystemMessage
+from langgraph.constants import TAG_NOSTREAM
+
+from ex_app.lib.metrics import HISTORY_COMPACTIONS
+from ex_app.lib.nc_model import ChatWithNextcloud, extract_text_content
+
+# estimated tokens of the conversation history above which the oldest turns are summarized
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "16000"))
+# share of the budget the history is reduced to, so that not every following turn compacts again
+HISTORY_TOKEN_TARGET = 0.5
+# characters per token, a rough estimate that holds for most languages and JSON
+CHARS_PER_TOKEN = 4
+# how much of a single message is passed on to the summary
+SUMMARY_MESSAGE_MAX_LENGTH = 2000
+
+SUMMARY_PROMPT = """
+You maintain the summary of an ongoing conversation between a user and an AI assistant that uses tools.
+Update the existing summary with the new part of the conversation. Keep facts, names, ids, links, decisions, open questions and results of tool calls that may still be needed later. Leave out small talk.
+Only output the updated summary, in the language of the conversation.
+"""
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+	size = len(json.dumps(message.content, ensure_ascii=False))
+	tool_calls = getattr(message, 'tool_calls', None)
+	if tool_calls:
+		size += len(json.dumps(tool_calls, ensure_ascii=False, default=str))
+	return size // CHARS_PER_TOKEN + 1
+
+
+def _split_index(messages: Sequence[BaseMessage], sizes: list[int], max_history: int) -> int:
+	"""
+	The index of the first message to keep
+
+	Only a human message can start the kept part, so that tool calls and their results stay
+	together, and the current turn is always kept.
+
+	:param max_history: The number of messages the model sends at most
+	"""
+	target = HISTORY_TOKEN_BUDGET * HISTORY_TOKEN_TARGET
+	last_human = max((i for i, message in enumerate(messages) if message.type == 'human'), default=0)
+	kept_tokens = 0
+	kept_non_tool = 0
+	split = last_human
+	for i in range(len(messages) - 1, 0, -1):
+		kept_tokens += sizes[i]
+		if messages[i].type != 'tool':
+			kept_non_tool += 1
+		if kept_tokens > target or kept_non_tool > max_history // 2:
+			break
+		if messages[i].type == 'human':
+			split = min(split, i)
+	return split
+
+
+def _transcript(messages: Sequence[BaseMessage]) -> str:
+	lines = []
+	for message in messages:
+		text = extract_text_content(message.content)
+		if len(text) > SUMMARY_MESSAGE_MAX_LENGTH:
+			text = text[:SUMMARY_MESSAGE_MAX_LENGTH] + "…[truncated]"
+		if message.type == 'tool':
+			lines.append(f"tool result ({message.name}): {text}")
+		elif message.type == 'ai':
+			for tool_call in getattr(message, 'tool_calls', None) or []:
+				lines.append(f"assistant called {tool_call['name']} with {json.dumps(tool_call['args'], ensure_ascii=False, default=str)}")
+			if text:
+				lines.append(f"assistant: {text}")
+		else:
+			lines.append(f"{message.type}: {text}")
+	return "\n".join(lines)
+
+
+async def compact_history(model: ChatWithNextcloud, messages: Sequence[BaseMessage], summary: str) -> dict | None:
+	"""
+	Fold the oldest turns into the running summary once the history exceeds its budget
+
+	Compacting before the history exceeds the message limit of the model keeps the model
+	from cutting off turns without a summary.
+
+	:param model: A chat model without tools, used to write the summary
+	:param summary: The summary of the turns folded so far
+	:return: The state update removing the folded messages and storing the new summary, or None
+	"""
+	sizes = [estimate_tokens(message) for message in messages]
+	non_tool_count = sum(1 for message in messages if message.type != 'tool')
+	if sum(sizes) <= HISTORY_TOKEN_BUDGET and non_tool_count <= model.MAX_MESSAGE_HISTORY:
+		return None
+	split = _split_index(messages, sizes, model.MAX_MESSAGE_HISTORY)
+	if split <= 0:
+		return None
+	folded = messages[:split]
+	if any(message.id is None for message in folded):
+		# messages without an id can't be removed from the state
+		return None
+
+	prompt = f"Existing summary:\n{summary or '(none)'}\n\nNew part of the conversation:\n{_transcript(folded)}"
+	# the summary is not part of the answer, so it must not be streamed to the user
+	response = await model.ainvoke([SystemMessage(SUMMARY_PROMPT), HumanMessage(prompt)], {"tags": [TAG_NOSTREAM]})
+	new_summary = extract_text_content(response.content).strip()
+	if not new_summary:
+		return None
+
+	HISTORY_COMPACTIONS.inc()
+	return {
+		"summary": new_summary,
+		"messages": [RemoveMessage(id=message.id) for message in folded],
+	}
@@ -17,6 +17,8 @@ class AgentState(TypedDict):
 	# add_messages is a reducer
 	# See https://langchain-ai.github.io/langgraph/concepts/low_level/#reducers
 	messages: Annotated[Sequence[BaseMessage], add_messages]
+	# summary of the earlier turns that were removed from messages
+	summary: str
 
 
 def handle_tool_error(state) -> dict:
@@ -34,12 +36,15 @@ def handle_tool_error(state) -> dict:
 		]
 	}
 
-def create_tool_node_with_fallback(tools: list) -> dict:
-	return ToolNode(tools).with_fallbacks(
+def create_tool_node_with_fallback(tools: list, process_output=None) -> dict:
+	node = ToolNode(tools)
+	if process_output is not None:
+		node = node | RunnableLambda(process_output)
+	return node.with_fallbacks(
 		[RunnableLambda(handle_tool_error)], exception_key="error"
 	)
 
-async def get_graph(call_model, safe_tools, dangerous_tools, checkpointer):
+async def get_graph(call_model, safe_tools, dangerous_tools, checkpointer, process_tool_output=None):
 	dangerous_tool_names = {tool.name: tool for tool in dangerous_tools}
 	safe_tool_names = {tool.name: tool for tool in safe_tools}
 
@@ -48,8 +53,8 @@ async def get_graph(call_model, safe_tools, dangerous_tools, checkpointer):
 
 	# Define the two nodes we will cycle between
 	workflow.add_node("agent", call_model)
-	workflow.add_node("safe_tools", create_tool_node_with_fallback(safe_tools))
-	workflow.add_node("dangerous_tools", create_tool_node_with_fallback(dangerous_tools))
+	workflow.add_node("safe_tools", create_tool_node_with_fallback(safe_tools, process_tool_output))
+	workflow.add_node("dangerous_tools", create_tool_node_with_fallback(dangerous_tools, process_tool_output))
 
 	# Set the entrypoint as `agent`
 	# This means that this node is the first one called
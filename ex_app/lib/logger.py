@@ -2,16 +2,123 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import asyncio
 import logging
+from collections.abc import Callable
+from time import monotonic
+from typing import Any
+
+from nc_py_api.ex_app import LogLvl
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', handlers=[logging.StreamHandler()])
 logger = logging.getLogger('context_agent')
 logger.setLevel(logging.INFO)
 
-async def log(nc, level, content):
-	logger.log((level+1)*10, content)
-	try:
-		await nc.log(level, content)
-	except asyncio.CancelledError:
-		raise
-	except Exception:
-		pass
\ No newline at end of file
+LOG_QUEUE_SIZE = 1000
+LOG_BATCH_SIZE = 50
+# how often the Nextcloud log level is re-read from the capabilities
+LOG_LEVEL_REFRESH_INTERVAL = 5 * 60
+
+
+class LogShipper:
+	"""
+	Sends log messages to Nextcloud in the background
+
+	Messages go into a bounded queue and are shipped by a single coroutine, the messages of a
+	batch are joined into one request per session and level. When the queue is full, new
+	messages are dropped instead of slowing down the caller.
+
+	Until the log level of Nextcloud has been read, only warnings and errors are shipped.
+	"""
+
+	def __init__(self, maxsize: int = LOG_QUEUE_SIZE):
+		self.maxsize = maxsize
+		self.queue: asyncio.Queue | None = None
+		self.worker: asyncio.Task | None = None
+		self.dropped = 0
+		# the minimum level Nextcloud accepts, as read from the capabilities
+		self.nc_level = LogLvl.WARNING
+		self.nc_level_updated_at = -LOG_LEVEL_REFRESH_INTERVAL
+		self.refresh: asyncio.Task | None = None
+
+	def accepts(self, level: int) -> bool:
+		return level >= self.nc_level
+
+	def refresh_nc_level(self, nc):
+		"""Re-read the log level of Nextcloud in the background once it is due"""
+		if monotonic() - self.nc_level_updated_at < LOG_LEVEL_REFRESH_INTERVAL:
+			return
+		self.nc_level_updated_at = monotonic()
+		self.refresh = asyncio.get_running_loop().create_task(self._refresh_nc_level(nc))
+
+	def ship(self, nc, level: int, message: str):
+		if self.worker is None or self.worker.done():
+			self.queue = asyncio.Queue(self.maxsize)
+			self.worker = asyncio.get_running_loop().create_task(self._run())
+		try:
+			self.queue.put_nowait((nc, level, message))
+		except asyncio.QueueFull:
+			self.dropped += 1
+
+	async def flush(self, timeout: float = 5):
+		"""Wait until the queued messages have been shipped"""
+		if self.queue is None or self.worker is None or self.worker.done():
+			return
+		try:
+			await asyncio.wait_for(self.queue.join(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	async def _run(self):
+		while True:
+			batch = [await self.queue.get()]
+			while len(batch) < LOG_BATCH_SIZE and not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+			try:
+				for nc, level, messages in self._group(batch):
+					if self.accepts(level):
+						await nc.log(level, "\n".join(messages), fast_send=True)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				pass
+			finally:
+				for _ in batch:
+					self.queue.task_done()
+
+	def _group(self, batch: list[tuple[Any, int, str]]) -> list[tuple[Any, int, list[str]]]:
+		groups: dict[tuple[int, int], tuple[Any, int, list[str]]] = {}
+		for nc, level, message in batch:
+			groups.setdefault((id(nc), level), (nc, level, []))[2].append(message)
+		return list(groups.values())
+
+	async def _refresh_nc_level(self, nc):
+		try:
+			self.nc_level = int((await nc.capabilities)["app_api"].get("loglevel", LogLvl.WARNING))
+		except Exception:
+			# keep the last known level
+			pass
+
+
+shipper = LogShipper()
+
+
+async def log(nc, level, content: Any | Callable[[], Any]):
+	"""
+	Log to stdout and, in the background, to the Nextcloud log
+
+	:param content: The message, or a callable returning it, which is only called when the level is enabled
+	"""
+	python_level = (level + 1) * 10
+	shipper.refresh_nc_level(nc)
+	to_stdout = logger.isEnabledFor(python_level)
+	to_nextcloud = shipper.accepts(level)
+	if not to_stdout and not to_nextcloud:
+		return
+	message = str(content() if callable(content) else content)
+	if to_stdout:
+		logger.log(python_level, message)
+	if to_nextcloud:
+		shipper.ship(nc, level, message)
+
+
+async def flush_logs(timeout: float = 5):
+	await shipper.flush(timeout)
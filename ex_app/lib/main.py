@@ -1,16 +1,19 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import concurrent.futures
+import functools
 import os
+import signal
 import traceback
 from contextlib import asynccontextmanager
 from json import JSONDecodeError
-from threading import Event
+from time import monotonic
 import asyncio
 
 from niquests import RequestException
 import json
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from nc_py_api import NextcloudApp, NextcloudException, AsyncNextcloudApp
 from nc_py_api.ex_app import (
     AppAPIAuthMiddleware,
@@ -21,11 +24,16 @@ from nc_py_api.ex_app import (
     SettingsField,
     SettingsFieldType)
 
+from ex_app.lib import metrics
 from ex_app.lib.agent import react
-from ex_app.lib.logger import log
+from ex_app.lib.logger import flush_logs, log
 from ex_app.lib.mcp_server import UserAuthMiddleware, ToolListMiddleware
 from ex_app.lib.provider import provider, multimodal_provider
+from ex_app.lib.scheduler import PollingScheduler, TaskScheduler
 from ex_app.lib.tools import get_categories
+from ex_app.lib.tracing import span, start_trace
+from ex_app.lib.watchdog import TaskCancelled, TaskWatchdog
+from ex_app.lib.workers import MP_CONTEXT, WorkerSupervisor, forward_trigger
 
 PROVIDERS = [provider, multimodal_provider]
 PROVIDER_IDS = [p.id for p in PROVIDERS]
@@ -42,10 +50,34 @@ http_mcp_app = mcp.http_app("/", transport="http", stateless_http=True)
 
 fast_app = FastAPI(lifespan=http_mcp_app.lifespan)
 
-app_enabled = Event()
-TRIGGER = asyncio.Event()
-IDLE_POLLING_INTERVAL = 5
-IDLE_POLLING_INTERVAL_WITH_TRIGGER = 5 * 60
+# a multiprocessing event, so that it can be shared with the worker processes
+app_enabled = MP_CONTEXT.Event()
+POLLING = PollingScheduler()
+
+TASK_SCHEDULER = TaskScheduler(
+    max_running=int(os.getenv("MAX_CONCURRENT_TASKS", "20")),
+    max_per_user=int(os.getenv("MAX_CONCURRENT_TASKS_PER_USER", "5")),
+    max_queued=int(os.getenv("MAX_QUEUED_TASKS", "5")),
+    prefetch=int(os.getenv("PREFETCH_TASKS", "0")),
+)
+# with more than one worker process the task loop runs in child processes and the parent only serves the app
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# seconds that in-flight tasks get to finish when the app is disabled or the container stops
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+# seconds between checks whether a running task was cancelled in Nextcloud
+CANCELLATION_CHECK_INTERVAL = float(os.getenv("CANCELLATION_CHECK_INTERVAL", "15"))
+WORKER_SUPERVISOR: WorkerSupervisor | None = None
+# seconds between two metrics snapshots of a worker process
+METRICS_PUBLISH_INTERVAL = 5
+CLAIM_LOOP: asyncio.Task | None = None
+SUPERVISOR_MONITOR: asyncio.Task | None = None
+
+metrics.Gauge('context_agent_tasks_running', 'Tasks currently running', lambda: TASK_SCHEDULER.running)
+metrics.Gauge('context_agent_tasks_queued', 'Claimed tasks waiting for a free slot', lambda: TASK_SCHEDULER.queue_depth)
+metrics.Gauge('context_agent_polling_triggers_trusted', 'Number of claim loops that rely on triggers while idle', lambda: int(POLLING.state()['triggers_trusted']))
+metrics.Gauge('context_agent_polling_triggers_received', 'Triggers received from Nextcloud', lambda: POLLING.state()['triggers_received'])
+metrics.Gauge('context_agent_polling_triggers_lost', 'Tasks found that no trigger announced while relying on triggers', lambda: POLLING.state()['triggers_lost'])
+metrics.Gauge('context_agent_polling_interval_seconds', 'Longest last wait of the claim loops before polling for the next task', lambda: POLLING.state()['last_interval'], max)
 
 LOCALE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "locale")
 current_translator = ContextVar("current_translator")
@@ -72,6 +104,15 @@ async def exapp_lifespan(app: FastAPI):
     if nc.enabled_state:
         app_enabled.set()
     yield
+    if WORKER_SUPERVISOR is not None:
+        if SUPERVISOR_MONITOR is not None:
+            # stopped workers must not be restarted
+            SUPERVISOR_MONITOR.cancel()
+        await asyncio.to_thread(WORKER_SUPERVISOR.stop, DRAIN_TIMEOUT + 10)
+    elif CLAIM_LOOP is not None:
+        CLAIM_LOOP.cancel()
+        await drain_tasks(AsyncNextcloudApp())
+    await flush_logs()
 
 
 APP = FastAPI(lifespan=lifespan)
@@ -138,78 +179,126 @@ async def enabled_handler(enabled: bool, nc: AsyncNextcloudApp) -> str:
     return ""
 
 
+# Claims tasks from Nextcloud and hands them to the TASK_SCHEDULER, which runs them as slots free up
 async def background_thread_task():
     nc = AsyncNextcloudApp()
 
-    async with asyncio.TaskGroup() as tg:
-        while True:
-            if not app_enabled.is_set():
-                await asyncio.sleep(5)
-                continue
+    while True:
+        if not app_enabled.is_set():
+            if TASK_SCHEDULER.running > 0 or TASK_SCHEDULER.queue_depth > 0:
+                await drain_tasks(nc)
+            await asyncio.sleep(5)
+            continue
+        await TASK_SCHEDULER.resume()
 
-            try:
-                response = await nc.providers.task_processing.next_task(PROVIDER_IDS, TASK_TYPES)
-                if not response or not 'task' in response:
-                    async with NUM_RUNNING_TASKS_LOCK:
-                        no_tasks_running = NUM_RUNNING_TASKS == 0
-                    if no_tasks_running:
-                        # if there are no running tasks we will get a trigger
-                        await wait_for_task()
-                    else:
-                        # otherwise, wait with fast frequency
-                        await asyncio.sleep(2)
-                    continue
-            except (NextcloudException, RequestException, JSONDecodeError) as e:
-                tb_str = ''.join(traceback.format_exception(e))
-                await log(nc, LogLvl.WARNING, "Error fetching the next task " + tb_str)
-                await wait_for_task(5)
+        # stop claiming while we are at capacity (plus PREFETCH_TASKS, if configured),
+        # so that other replicas can pick up the tasks
+        await TASK_SCHEDULER.wait_for_capacity()
+
+        try:
+            claim_started_at = monotonic()
+            response = await nc.providers.task_processing.next_task(PROVIDER_IDS, TASK_TYPES)
+            metrics.TASK_CLAIM_SECONDS.observe(monotonic() - claim_started_at)
+            if not response or not 'task' in response:
+                # poll faster while tasks are in flight
+                await POLLING.wait_idle(busy=TASK_SCHEDULER.running > 0)
                 continue
+        except (NextcloudException, RequestException, JSONDecodeError) as e:
+            tb_str = ''.join(traceback.format_exception(e))
+            await log(nc, LogLvl.WARNING, "Error fetching the next task " + tb_str)
+            await POLLING.wait_after_error()
+            continue
+
+        POLLING.on_task_claimed()
+        task = response["task"]
+        await log(nc, LogLvl.INFO, lambda: 'New Task incoming ' + str(TASK_SCHEDULER.stats()))
+        await log(nc, LogLvl.DEBUG, lambda: str(task))
+        await log(nc, LogLvl.INFO, lambda: str({
+            'type': task.get('type'),
+            'input': task['input']['input'],
+            'confirmation': task['input']['confirmation'],
+            'conversation_token': '<skipped>',
+            'memories': task['input'].get('memories', None),
+            'input_attachments': task['input'].get('input_attachments', None),
+        }))
+        TASK_SCHEDULER.submit(
+            task.get('userId'),
+            functools.partial(handle_task, task, nc),
+            functools.partial(reject_task, task, nc),
+        )
 
-            task = response["task"]
-            await log(nc, LogLvl.INFO, 'New Task incoming')
-            await log(nc, LogLvl.DEBUG, str(task))
-            await log(nc, LogLvl.INFO, str({
-                'type': task.get('type'),
-                'input': task['input']['input'],
-                'confirmation': task['input']['confirmation'],
-                'conversation_token': '<skipped>',
-                'memories': task['input'].get('memories', None),
-                'input_attachments': task['input'].get('input_attachments', None),
-            }))
-            tg.create_task(handle_task(task, nc))
-
-NUM_RUNNING_TASKS_LOCK = asyncio.Lock()
-NUM_RUNNING_TASKS = 0
+async def drain_tasks(nc: AsyncNextcloudApp):
+    await log(nc, LogLvl.INFO, f"Draining in-flight tasks: {TASK_SCHEDULER.stats()}")
+    cancelled = await TASK_SCHEDULER.drain(DRAIN_TIMEOUT)
+    if cancelled > 0:
+        await log(nc, LogLvl.WARNING, f"Cancelled {cancelled} tasks that did not finish within {DRAIN_TIMEOUT}s")
+
+async def reject_task(task, nc: AsyncNextcloudApp):
+    # the task was claimed but a drain ended before it could start
+    try:
+        await nc.providers.task_processing.report_result(
+            task["id"],
+            error_message="Context Agent was stopped before the task could start. Please try again.",
+        )
+    except Exception:
+        pass
 
 async def handle_task(task, nc: AsyncNextcloudApp):
-    global NUM_RUNNING_TASKS
+    with start_trace("handle_task", **{"task.id": task["id"], "task.type": task.get("type", "")}):
+        await process_task(task, nc)
+
+async def process_task(task, nc: AsyncNextcloudApp):
+    started_at = monotonic()
     try:
-        async with NUM_RUNNING_TASKS_LOCK:
-            NUM_RUNNING_TASKS += 1
         nextcloud = AsyncNextcloudApp()
         if task['userId']:
             await nextcloud.set_user(task['userId'])
 
         stream_updates_enabled = task.get('preferStreaming', None) is True
         stream_update_failed = False
+        # tasks without a user cannot be looked up with the user's session
+        watchdog = TaskWatchdog(nextcloud, task['id'], CANCELLATION_CHECK_INTERVAL if task['userId'] else None)
 
         async def stream_output(intermediate_output):
             nonlocal stream_update_failed
             if not stream_updates_enabled or stream_update_failed:
                 return
             try:
-                await nc.ocs(
-                    "POST",
-                    f"/ocs/v2.php/taskprocessing/tasks_provider/{task['id']}/stream-result",
-                    json={"output": intermediate_output},
-                )
+                with span("nc.stream_result"):
+                    await nc.ocs(
+                        "POST",
+                        f"/ocs/v2.php/taskprocessing/tasks_provider/{task['id']}/stream-result",
+                        json={"output": intermediate_output},
+                    )
             except (NextcloudException, RequestException) as stream_err:
                 stream_update_failed = True
+                # the task might have been cancelled
+                watchdog.check_now()
                 tb_str = ''.join(traceback.format_exception(stream_err))
                 await log(nc, LogLvl.WARNING, "Error streaming intermediate task result: " + tb_str)
 
-        output = await react(task, nextcloud, stream_output=stream_output if stream_updates_enabled else None)
+        output = await watchdog.run(
+            react(task, nextcloud, stream_output=stream_output if stream_updates_enabled else None)
+        )
+        metrics.REACT_SECONDS.observe(monotonic() - started_at, outcome='success')
+    except TaskCancelled as e:
+        metrics.REACT_SECONDS.observe(monotonic() - started_at, outcome='cancelled')
+        # nobody is waiting for a result anymore
+        await log(nc, LogLvl.INFO, str(e))
+        return
+    except asyncio.CancelledError:
+        metrics.REACT_SECONDS.observe(monotonic() - started_at, outcome='interrupted')
+        # the task was cut off by a drain, report it so that the user doesn't have to wait for a timeout
+        try:
+            await nc.providers.task_processing.report_result(
+                task["id"],
+                error_message="Context Agent was stopped before the task could finish. Please try again.",
+            )
+        except Exception:
+            pass
+        raise
     except Exception as e:  # noqa
+        metrics.REACT_SECONDS.observe(monotonic() - started_at, outcome='error')
         try:
             tb_str = ''.join(traceback.format_exception(e))
             await log(nc, LogLvl.ERROR, "Error: " + tb_str)
@@ -217,53 +306,75 @@ async def handle_task(task, nc: AsyncNextcloudApp):
         except (NextcloudException, RequestException) as net_err:
             tb_str = ''.join(traceback.format_exception(net_err))
             await log(nc, LogLvl.WARNING, "Network error in reporting the error: " + tb_str)
-        finally:
-            async with NUM_RUNNING_TASKS_LOCK:
-                NUM_RUNNING_TASKS -= 1
         return
     try:
-        await nc.providers.task_processing.report_result(
-            task["id"],
-            output,
-        )
+        with span("nc.report_result"):
+            await nc.providers.task_processing.report_result(
+                task["id"],
+                output,
+            )
     except Exception as e:
         try:
             tb_str = ''.join(traceback.format_exception(e))
             await log(nc, LogLvl.ERROR, "Error trying to report the task result: " + tb_str)
         except Exception:
             pass
-    finally:
-        async with NUM_RUNNING_TASKS_LOCK:
-            NUM_RUNNING_TASKS -= 1
 
 
 
 def start_bg_task():
+    global WORKER_SUPERVISOR
+    global CLAIM_LOOP
+    global SUPERVISOR_MONITOR
     loop = asyncio.get_event_loop()
-    loop.create_task(background_thread_task())
+    if WORKER_PROCESSES > 1:
+        WORKER_SUPERVISOR = WorkerSupervisor(worker_main, WORKER_PROCESSES, app_enabled)
+        WORKER_SUPERVISOR.start()
+        SUPERVISOR_MONITOR = loop.create_task(WORKER_SUPERVISOR.monitor())
+    else:
+        CLAIM_LOOP = loop.create_task(background_thread_task())
+
+# Entry point of the worker processes in multi-process mode
+def worker_main(enabled, trigger, metrics_path):
+    global app_enabled
+    app_enabled = enabled
+
+    async def publish_metrics():
+        while True:
+            await asyncio.to_thread(metrics.write_snapshot, metrics_path)
+            await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        forward_trigger(trigger, loop, POLLING.on_trigger)
+        metrics_publisher = asyncio.create_task(publish_metrics())
+        # the supervisor terminates the workers with SIGTERM
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        claim_loop = asyncio.create_task(background_thread_task())
+        await stop.wait()
+        claim_loop.cancel()
+        await drain_tasks(AsyncNextcloudApp())
+        metrics_publisher.cancel()
+        await flush_logs()
+
+    asyncio.run(run())
 
 # Trigger event is available starting with nextcloud v33
 async def trigger_handler(providerId: str):
-    # now runs in the same thread as the task processing, which is why we can use asyncio.Event
-    global TRIGGER
-    TRIGGER.set()
-
-# Waits for interval seconds or IDLE_POLLING_INTERVAL seconds
-# but can return earlier when TRIGGER event is received from nextcloud
-# if the trigger event is received, IDLE_POLLING_INTERVAL is set to IDLE_POLLING_INTERVAL_WITH_TRIGGER
-async def wait_for_task(interval = None):
-    global TRIGGER
-    global IDLE_POLLING_INTERVAL
-    global IDLE_POLLING_INTERVAL_WITH_TRIGGER
-    if interval is None:
-        interval = IDLE_POLLING_INTERVAL
-    try:
-        await asyncio.wait_for(TRIGGER.wait(), timeout=interval)
-        # In case we received the event, we change the polling interval
-        IDLE_POLLING_INTERVAL = IDLE_POLLING_INTERVAL_WITH_TRIGGER
-    except asyncio.TimeoutError:
-        pass
-    TRIGGER.clear()
+    # now runs in the same thread as the task processing, which is why the polling scheduler can use an asyncio.Event
+    if WORKER_SUPERVISOR is not None:
+        WORKER_SUPERVISOR.trigger()
+    else:
+        POLLING.on_trigger()
+
+
+@APP.get("/metrics", response_class=PlainTextResponse)
+async def metrics_handler():
+    if WORKER_SUPERVISOR is not None:
+        # the tasks run in the worker processes, add up what they published
+        return metrics.render(await asyncio.to_thread(metrics.read_snapshots, WORKER_SUPERVISOR.metrics_paths))
+    return metrics.render()
 
 
 APP.mount("/mcp", http_mcp_app)
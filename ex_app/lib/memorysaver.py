@@ -74,6 +74,8 @@ class InMemorySaver(
 	]
 
 	last_config: Optional[dict] = None
+	# id of the conversation in the conversation store, if it is stored there
+	conversation_id: Optional[str] = None
 
 	def __init__(
 			self,
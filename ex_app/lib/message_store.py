@@ -0,0 +1,158 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import hashlib
+import os
+import time
+from typing import Any
+
+import ormsgpack
+from langgraph.checkpoint.base import SerializerProtocol
+from nc_py_api.ex_app import persistent_storage
+
+from ex_app.lib.checkpoint_store import CONVERSATION_MAX_AGE_DAYS
+
+# "1" keeps the messages of the conversations in this container, the tokens only carry their hashes and the new messages.
+# Opt-in, the tokens can only be loaded by instances that share the persistent storage.
+CONVERSATION_TOKEN_DELTA = os.getenv("CONVERSATION_TOKEN_DELTA", "0") == "1"
+GC_INTERVAL = 60 * 60
+
+
+class MessageBlobStore:
+	"""
+	Content-addressed storage of serialized conversation messages
+
+	A blob is written once and never changes. Using it again renews its modification time,
+	blobs that haven't been used for CONVERSATION_MAX_AGE_DAYS are removed.
+	"""
+
+	def __init__(self, directory: str):
+		self.directory = directory
+		self.last_gc = 0.0
+
+	def _path(self, digest: str) -> str:
+		return os.path.join(self.directory, digest[:2], digest)
+
+	def put(self, digest: str, blob: bytes) -> bool:
+		"""Store a blob, False if it couldn't be stored"""
+		path = self._path(digest)
+		try:
+			if os.path.exists(path):
+				os.utime(path)
+				return True
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			tmp_path = f"{path}.{os.getpid()}.tmp"
+			with open(tmp_path, "wb") as file:
+				file.write(blob)
+			os.replace(tmp_path, path)
+		except OSError:
+			return False
+		self._collect_garbage()
+		return True
+
+	def touch(self, digest: str) -> bool:
+		"""Renew a blob, False if it isn't stored"""
+		try:
+			os.utime(self._path(digest))
+			return True
+		except OSError:
+			return False
+
+	def get(self, digest: str) -> bytes | None:
+		path = self._path(digest)
+		try:
+			with open(path, "rb") as file:
+				blob = file.read()
+			os.utime(path)
+		except OSError:
+			return None
+		if hashlib.sha256(blob).hexdigest() != digest:
+			return None
+		return blob
+
+	def _collect_garbage(self):
+		now = time.time()
+		if now - self.last_gc < GC_INTERVAL:
+			return
+		self.last_gc = now
+		max_age = CONVERSATION_MAX_AGE_DAYS * 24 * 60 * 60
+		for root, _, files in os.walk(self.directory):
+			for name in files:
+				path = os.path.join(root, name)
+				try:
+					if now - os.path.getmtime(path) > max_age:
+						os.remove(path)
+				except OSError:
+					pass
+
+
+_store: MessageBlobStore | None = None
+
+
+def get_message_store() -> MessageBlobStore | None:
+	"""The message store of this container, None when the tokens carry all messages"""
+	global _store
+	if not CONVERSATION_TOKEN_DELTA:
+		return None
+	if _store is None:
+		_store = MessageBlobStore(os.path.join(persistent_storage(), "message_blobs"))
+	return _store
+
+
+def split_messages(state: dict[str, Any], serde: SerializerProtocol, store: MessageBlobStore) -> dict[str, Any]:
+	"""
+	Replace the messages of the exported checkpoint by their hashes
+
+	Messages that are already in the store are only referenced. New messages are stored and
+	carried inline as well. If the store can't take them, the token still works without it.
+	"""
+	checkpoint_typed, metadata_typed, parent = state['last_checkpoint']
+	checkpoint = serde.loads_typed(checkpoint_typed)
+	if 'messages' not in checkpoint['channel_values']:
+		return state
+	messages = checkpoint['channel_values'].pop('messages')
+	refs = []
+	inline = {}
+	for message in messages:
+		blob = ormsgpack.packb(serde.dumps_typed(message))
+		digest = hashlib.sha256(blob).hexdigest()
+		refs.append(digest)
+		if store.touch(digest):
+			# stored by an earlier turn, the reference is enough
+			continue
+		store.put(digest, blob)
+		inline[digest] = blob
+	return {
+		**state,
+		'last_checkpoint': (serde.dumps_typed(checkpoint), metadata_typed, parent),
+		'message_refs': refs,
+		'inline_messages': inline,
+	}
+
+
+def join_messages(state: dict[str, Any], serde: SerializerProtocol, store: MessageBlobStore | None) -> dict[str, Any]:
+	"""Put the referenced messages back into the checkpoint of a delta-encoded state"""
+	if 'message_refs' not in state:
+		return state
+	inline = state.get('inline_messages') or {}
+	messages = []
+	for digest in state['message_refs']:
+		blob = inline.get(digest)
+		if blob is not None:
+			if store is not None:
+				# the next token of this conversation only needs to reference it
+				store.put(digest, blob)
+		else:
+			blob = store.get(digest) if store is not None else None
+			if blob is None:
+				raise Exception(
+					"The conversation references messages that are not available in this instance,"
+					" they have expired or were stored by an instance with another persistent storage"
+				)
+		messages.append(serde.loads_typed(tuple(ormsgpack.unpackb(blob))))
+	checkpoint_typed, metadata_typed, parent = state['last_checkpoint']
+	checkpoint = serde.loads_typed(checkpoint_typed)
+	checkpoint['channel_values']['messages'] = messages
+	return {
+		'last_config': state['last_config'],
+		'last_checkpoint': (serde.dumps_typed(checkpoint), metadata_typed, parent),
+	}
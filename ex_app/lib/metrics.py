@@ -0,0 +1,222 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Minimal in-process metrics in the Prometheus text exposition format, served at /metrics.
+# The values are kept per process, worker processes publish snapshots that the parent adds up.
+import bisect
+import json
+import os
+from collections import defaultdict
+from collections.abc import Callable
+from time import monotonic
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+_registry: list['_Metric'] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+	parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		parts.append(extra)
+	return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+	kind = ''
+
+	def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		_registry.append(self)
+
+	def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+		return tuple(str(labels.get(name, '')) for name in self.labels)
+
+	def snapshot(self) -> Any:
+		raise NotImplementedError
+
+	def samples(self, others: list[Any]) -> list[str]:
+		"""The samples of this process, added up with the snapshots of the other processes"""
+		raise NotImplementedError
+
+	def render(self, others: list[Any]) -> str:
+		lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+		lines += self.samples(others)
+		return '\n'.join(lines)
+
+
+class Counter(_Metric):
+	kind = 'counter'
+
+	def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+		super().__init__(name, description, labels)
+		self.values: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+	def inc(self, amount: float = 1, **labels: str):
+		self.values[self._key(labels)] += amount
+
+	def snapshot(self) -> list:
+		return [[list(key), value] for key, value in self.values.items()]
+
+	def samples(self, others: list[Any]) -> list[str]:
+		values = defaultdict(float, self.values)
+		for other in others:
+			for key, value in other:
+				values[tuple(key)] += value
+		return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in values.items()]
+
+
+class Gauge(_Metric):
+	"""
+	A gauge whose value is read from a callback when the metrics are rendered
+
+	:param aggregate: How the values of several processes are combined
+	"""
+	kind = 'gauge'
+
+	def __init__(self, name: str, description: str, callback: Callable[[], float], aggregate: Callable[[list[float]], float] = sum):
+		super().__init__(name, description)
+		self.callback = callback
+		self.aggregate = aggregate
+
+	def snapshot(self) -> float:
+		return self.callback()
+
+	def samples(self, others: list[Any]) -> list[str]:
+		return [f'{self.name} {self.aggregate([self.callback(), *others])}']
+
+
+class Histogram(_Metric):
+	kind = 'histogram'
+
+	def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+		super().__init__(name, description, labels)
+		self.buckets = buckets
+		self.counts: dict[tuple[str, ...], list[int]] = {}
+		self.sums: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+	def observe(self, value: float, **labels: str):
+		key = self._key(labels)
+		if key not in self.counts:
+			self.counts[key] = [0] * (len(self.buckets) + 1)
+		self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+		self.sums[key] += value
+
+	def summary(self) -> dict[str, float]:
+		"""Count and average over all label values, for logging"""
+		count = sum(sum(counts) for counts in self.counts.values())
+		total = sum(self.sums.values())
+		return {
+			'count': count,
+			'avg': round(total / count, 3) if count else 0.0,
+		}
+
+	def snapshot(self) -> list:
+		return [[list(key), counts, self.sums[key]] for key, counts in self.counts.items()]
+
+	def samples(self, others: list[Any]) -> list[str]:
+		all_counts = {key: list(counts) for key, counts in self.counts.items()}
+		sums = defaultdict(float, self.sums)
+		for other in others:
+			for key, counts, total in other:
+				key = tuple(key)
+				if key in all_counts:
+					all_counts[key] = [a + b for a, b in zip(all_counts[key], counts)]
+				else:
+					all_counts[key] = list(counts)
+				sums[key] += total
+		lines = []
+		for key, counts in all_counts.items():
+			cumulative = 0
+			for bound, count in zip((*self.buckets, '+Inf'), counts):
+				cumulative += count
+				le = 'le="' + str(bound) + '"'
+				lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+			lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {sums[key]}')
+			lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+		return lines
+
+
+def snapshot() -> dict[str, Any]:
+	return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def write_snapshot(path: str):
+	"""Publish the metrics of this worker process for the parent to render"""
+	tmp_path = f'{path}.tmp'
+	with open(tmp_path, 'w') as file:
+		json.dump(snapshot(), file)
+	os.replace(tmp_path, path)
+
+
+def read_snapshots(paths: list[str]) -> list[dict[str, Any]]:
+	snapshots = []
+	for path in paths:
+		try:
+			with open(path) as file:
+				snapshots.append(json.load(file))
+		except (OSError, ValueError):
+			# the worker hasn't published its metrics yet
+			pass
+	return snapshots
+
+
+def render(snapshots: list[dict[str, Any]] | None = None) -> str:
+	"""
+	Render the metrics of this process
+
+	:param snapshots: Snapshots of the worker processes to add up with the values of this process
+	"""
+	return '\n'.join(
+		metric.render([snapshot[metric.name] for snapshot in snapshots or [] if metric.name in snapshot])
+		for metric in _registry
+	) + '\n'
+
+
+TASK_CLAIM_SECONDS = Histogram('context_agent_task_claim_seconds', 'Duration of the requests for the next task')
+TASK_CLAIM_TO_START_SECONDS = Histogram('context_agent_task_claim_to_start_seconds', 'Time between claiming a task and starting it')
+REACT_SECONDS = Histogram('context_agent_react_seconds', 'Duration of agent runs', ('outcome',))
+LLM_TASKS_SCHEDULED = Counter('context_agent_llm_tasks_scheduled_total', 'Chat with tools tasks scheduled', ('task_type',))
+LLM_TASK_POLLS = Counter('context_agent_llm_task_polls_total', 'Polls of chat with tools tasks', ('task_type',))
+LLM_WAIT_SECONDS = Histogram('context_agent_llm_wait_seconds', 'Time spent waiting for chat with tools tasks', ('task_type',))
+LLM_CACHE_HITS = Counter('context_agent_llm_cache_hits_total', 'Chat with tools requests answered from the response cache', ('task_type',))
+TOOL_CALL_SECONDS = Histogram('context_agent_tool_call_seconds', 'Duration of tool calls', ('tool',))
+TOOL_CALL_ERRORS = Counter('context_agent_tool_call_errors_total', 'Failed tool calls', ('tool',))
+HISTORY_COMPACTIONS = Counter('context_agent_history_compactions_total', 'Conversation histories folded into their summary')
+CONVERSATION_TOKEN_BYTES = Histogram('context_agent_conversation_token_bytes', 'Size of the exported conversation tokens', buckets=SIZE_BUCKETS)
+CONVERSATION_TOKEN_DECODE_SECONDS = Histogram('context_agent_conversation_token_decode_seconds', 'Duration of loading conversation tokens', ('format',), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+
+class ToolMetricsCallbackHandler(AsyncCallbackHandler):
+	"""Records latency and errors of every tool call in the agent graph"""
+
+	def __init__(self):
+		self.started: dict[UUID, tuple[str, float]] = {}
+
+	async def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+		self.started[run_id] = ((serialized or {}).get('name') or 'unknown', monotonic())
+
+	async def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+		self._finish(run_id)
+
+	async def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+		tool = self._finish(run_id)
+		if tool is not None:
+			TOOL_CALL_ERRORS.inc(tool=tool)
+
+	def _finish(self, run_id: UUID) -> str | None:
+		if run_id not in self.started:
+			return None
+		tool, started_at = self.started.pop(run_id)
+		TOOL_CALL_SECONDS.observe(monotonic() - started_at, tool=tool)
+		return tool
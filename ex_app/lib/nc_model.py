@@ -1,8 +1,11 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
-import asyncio
+import hashlib
 import json
+import os
 import typing
+from collections import OrderedDict
+from time import monotonic
 from collections.abc import AsyncIterator
 from typing import Optional, Any, Sequence, Union, Callable
 
@@ -21,7 +24,16 @@ from pydantic import BaseModel, ValidationError
 
 from langchain_core.language_models.chat_models import BaseChatModel
 
+from ex_app.lib.all_tools.lib.retry import CircuitOpenError, NON_IDEMPOTENT_RETRY_POLICY, retry_ocs
+from ex_app.lib.all_tools.lib.task_processing import (
+	PollSchedule,
+	task_poller,
+	track_scheduled_task,
+	untrack_scheduled_task,
+)
 from ex_app.lib.logger import log
+from ex_app.lib.metrics import LLM_CACHE_HITS, LLM_TASK_POLLS, LLM_TASKS_SCHEDULED, LLM_WAIT_SECONDS
+from ex_app.lib.tracing import traced
 
 
 TEXT_CHAT_WITH_TOOLS = "core:text2text:chatwithtools"
@@ -68,11 +80,125 @@ def build_multimodal_content(text: str, file_ids: list[int] | None = None, task_
 	return content
 
 
+ToolLike = Union[typing.Dict[str, Any], type, Callable, BaseTool]
+
+# number of distinct toolsets whose converted schemas are kept
+TOOLSET_CACHE_SIZE = 32
+# number of single tools whose converted schema is kept
+TOOL_CACHE_SIZE = 1024
+
+# number of encoded history entries that are kept
+HISTORY_CACHE_SIZE = 4096
+
+_toolset_cache: OrderedDict[tuple, tuple[list[dict[str, Any]], str]] = OrderedDict()
+_tool_cache: OrderedDict[tuple, dict[str, Any]] = OrderedDict()
+# encoded history entries by message id and whether the entry is truncated
+_history_cache: OrderedDict[tuple[str, bool], str] = OrderedDict()
+
+
+def _tool_fingerprint(tool: ToolLike) -> tuple:
+	"""
+	Identify a tool by what its OpenAI schema is generated from
+
+	The tool objects are created anew by get_tools, but the module, name and docstring of a tool
+	only change with the code. Schemas that are not defined in code (e.g. those of MCP tools)
+	are part of the fingerprint.
+	"""
+	if isinstance(tool, dict):
+		return ('dict', json.dumps(tool, sort_keys=True, default=str))
+	if isinstance(tool, BaseTool):
+		action = getattr(tool, 'coroutine', None) or getattr(tool, 'func', None)
+		schema = tool.args_schema
+		return (
+			type(tool).__module__,
+			getattr(action, '__module__', None),
+			tool.name,
+			tool.description,
+			json.dumps(schema, sort_keys=True, default=str) if isinstance(schema, dict) else getattr(schema, '__name__', None),
+		)
+	return (getattr(tool, '__module__', None), getattr(tool, '__qualname__', None), getattr(tool, '__doc__', None))
+
+
+def _convert_tool(tool: ToolLike, fingerprint: tuple) -> dict[str, Any]:
+	schema = _tool_cache.get(fingerprint)
+	if schema is None:
+		schema = convert_to_openai_tool(tool)
+		_tool_cache[fingerprint] = schema
+		if len(_tool_cache) > TOOL_CACHE_SIZE:
+			_tool_cache.popitem(last=False)
+	else:
+		_tool_cache.move_to_end(fingerprint)
+	return schema
+
+
+def convert_tools(tools: Sequence[ToolLike]) -> tuple[list[dict[str, Any]], str]:
+	"""
+	Convert tools to the OpenAI format, cached by the fingerprint of the toolset
+
+	:return: The schemas and their serialization for the task input
+	"""
+	fingerprints = [_tool_fingerprint(tool) for tool in tools]
+	key = tuple(fingerprints)
+	cached = _toolset_cache.get(key)
+	if cached is not None:
+		_toolset_cache.move_to_end(key)
+		return cached
+	schemas = [_convert_tool(tool, fingerprint) for tool, fingerprint in zip(tools, fingerprints)]
+	cached = (schemas, json.dumps(schemas))
+	_toolset_cache[key] = cached
+	if len(_toolset_cache) > TOOLSET_CACHE_SIZE:
+		_toolset_cache.popitem(last=False)
+	return cached
+
+
+# seconds a response to an identical chat with tools request is reused, 0 disables the cache
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "0"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+
+
+class LLMResponseCache:
+	"""LRU cache of successful chat with tools tasks by the hash of their input, entries expire after `ttl` seconds"""
+
+	def __init__(self, ttl: float = LLM_CACHE_TTL, max_size: int = LLM_CACHE_SIZE):
+		self.ttl = ttl
+		self.max_size = max_size
+		self.entries: OrderedDict[str, tuple[float, 'Task']] = OrderedDict()
+
+	@property
+	def enabled(self) -> bool:
+		return self.ttl > 0 and self.max_size > 0
+
+	def key(self, user_id: str, task_type: str, task_input: dict[str, typing.Any]) -> str:
+		normalized = json.dumps([user_id, task_type, task_input], sort_keys=True, ensure_ascii=False, default=str)
+		return hashlib.sha256(normalized.encode()).hexdigest()
+
+	def get(self, key: str) -> 'Task | None':
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		expires_at, task = entry
+		if monotonic() >= expires_at:
+			del self.entries[key]
+			return None
+		self.entries.move_to_end(key)
+		return task
+
+	def put(self, key: str, task: 'Task'):
+		self.entries[key] = (monotonic() + self.ttl, task)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+
+
+llm_cache = LLMResponseCache()
+
+
 class Task(BaseModel):
 	id: int
 	status: str
 	output: dict[str, typing.Any] | None = None
 	preferStreaming: bool | None = None
+	completionExpectedAt: int | None = None
 
 
 class Response(BaseModel):
@@ -83,13 +209,18 @@ class ChatWithNextcloud(BaseChatModel):
 	nc: AsyncNextcloudApp = AsyncNextcloudApp()
 	tools: Sequence[
 		Union[typing.Dict[str, Any], type, Callable, BaseTool]] = []
+	# the serialized tools, as sent with each task
+	tools_json: str = '[]'
 	TIMEOUT: int = 60 * 30 # 30 minutes
 	MAX_MESSAGE_HISTORY: int = 42
 	TOOL_OUTPUT_TRUNCATE_AFTER: int = 10
 	TOOL_OUTPUT_MAX_LENGTH: int = 2000
+	POLL_INITIAL_WAIT_TIME: float = 0.5
 	POLL_WAIT_TIME: int = 5
 	STREAMING_POLL_WAIT_TIME: int = 1
 	multimodal: bool = False
+	# tools with side effects: turns after their results and responses calling them are never cached
+	cache_bypass_tools: frozenset[str] = frozenset()
 
 	def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any):
 		raise Exception("Use _agenerate instead")
@@ -121,35 +252,29 @@ class ChatWithNextcloud(BaseChatModel):
 
 		task_input['input'] = ''
 		task_input['tool_message'] = []
-		task_input['tools'] = json.dumps(self.tools)
+		task_input['tools'] = self.tools_json
 		if self.multimodal:
 			task_input['input_attachments'] = []
 
 		history = []
 		for i, message in enumerate(messages):
 			if message.type == 'ai':
-				msg = {"role": "assistant", "content": message.content}
-				if len(message.tool_calls) > 0:
-					msg['tool_calls'] = message.tool_calls
-				history.append(json.dumps(msg))
+				history.append(self._history_entry(message))
 			elif message.type == 'human':
 				if len(messages)-1 != i:
 					# Earlier turns keep file parts in history content.
-					history.append(json.dumps({"role": "human", "content": message.content}))
+					history.append(self._history_entry(message))
 				else:
 					# Current turn: text → input, files → input_attachments.
 					task_input['input'] = extract_text_content(message.content)
 					if self.multimodal:
 						task_input['input_attachments'] = extract_file_ids(message.content)
 			elif message.type == 'tool':
-				content = message.content
 				age = len(messages) - 1 - i
-				if age > self.TOOL_OUTPUT_TRUNCATE_AFTER and isinstance(content, str) and len(content) > self.TOOL_OUTPUT_MAX_LENGTH:
-					content = content[:self.TOOL_OUTPUT_MAX_LENGTH] + "…[truncated]"
 				if len(messages)-1 != i:
-					history.append(json.dumps({"role": "tool", "content": content, "name": message.name, "tool_call_id": message.tool_call_id}))
+					history.append(self._history_entry(message, truncate=age > self.TOOL_OUTPUT_TRUNCATE_AFTER))
 				else:
-					task_input['tool_message'].append({"name": message.name, "content": content, "tool_call_id": message.tool_call_id})
+					task_input['tool_message'].append({"name": message.name, "content": message.content, "tool_call_id": message.tool_call_id})
 			else:
 				print(message)
 				raise Exception("Message type not found")
@@ -162,63 +287,89 @@ class ChatWithNextcloud(BaseChatModel):
 
 		return task_input
 
+	def _history_entry(self, message: BaseMessage, truncate: bool = False) -> str:
+		"""
+		Encode a message for the history of the task input
+
+		Messages don't change once they are in the conversation, so the encoding is cached by
+		message id and only the new messages of a turn are encoded.
+		"""
+		content = message.content
+		truncate = truncate and isinstance(content, str) and len(content) > self.TOOL_OUTPUT_MAX_LENGTH
+		key = (message.id, truncate)
+		if message.id is not None:
+			entry = _history_cache.get(key)
+			if entry is not None:
+				_history_cache.move_to_end(key)
+				return entry
+
+		if message.type == 'ai':
+			msg = {"role": "assistant", "content": content}
+			if len(message.tool_calls) > 0:
+				msg['tool_calls'] = message.tool_calls
+		elif message.type == 'human':
+			msg = {"role": "human", "content": content}
+		else:
+			if truncate:
+				content = content[:self.TOOL_OUTPUT_MAX_LENGTH] + "…[truncated]"
+			msg = {"role": "tool", "content": content, "name": message.name, "tool_call_id": message.tool_call_id}
+		entry = json.dumps(msg)
+
+		if message.id is not None:
+			_history_cache[key] = entry
+			if len(_history_cache) > HISTORY_CACHE_SIZE:
+				_history_cache.popitem(last=False)
+		return entry
+
+	@traced("llm.schedule_task")
 	async def _schedule_task(self, task_input: dict[str, typing.Any], prefer_streaming: bool = False) -> Task:
 		nc = self.nc
 
 		await log(nc, LogLvl.DEBUG, task_input)
 
-		task_type = MULTIMODAL_CHAT_WITH_TOOLS if self.multimodal else TEXT_CHAT_WITH_TOOLS
-
-		i = 0
-		while i < 20:
-			try:
-				response = await nc.ocs(
-					"POST",
-					"/ocs/v1.php/taskprocessing/schedule",
-					json={
-						"type": task_type,
-						"appId": "context_agent",
-						"input": task_input,
-						"preferStreaming": prefer_streaming,
-					},
-				)
-				break
-			except (
-					ConnectionError,
-					Timeout
-
-			) as e:
-				await log(nc, LogLvl.DEBUG, "Ignored error during task scheduling")
-				i += 1
-				await asyncio.sleep(1)
-				continue
+		task_type = self._task_type()
 
-		if i >= 20:
-			raise Exception("Failed to schedule task")
+		try:
+			response = await retry_ocs(lambda: nc.ocs(
+				"POST",
+				"/ocs/v1.php/taskprocessing/schedule",
+				json={
+					"type": task_type,
+					"appId": "context_agent",
+					"input": task_input,
+					"preferStreaming": prefer_streaming,
+				},
+			), NON_IDEMPOTENT_RETRY_POLICY)
+		except (
+				ConnectionError,
+				Timeout,
+				CircuitOpenError,
+		) as e:
+			raise Exception("Failed to schedule task") from e
 
+		LLM_TASKS_SCHEDULED.inc(task_type=task_type)
 		try:
 			task = Response.model_validate(response).task
 			await log(nc, LogLvl.DEBUG, task)
+			track_scheduled_task(task.id)
 			return task
 		except ValidationError as e:
 			raise Exception("Failed to parse Nextcloud TaskProcessing task result") from e
 
-	async def _poll_task(self, task_id: int, wait_time: int) -> Task:
+	@traced("llm.poll_task")
+	async def _poll_task(self, task_id: int, delay: float) -> Task:
 		nc = self.nc
+		LLM_TASK_POLLS.inc(task_type=self._task_type())
 		try:
-			response = await nc.ocs("GET", f"/ocs/v1.php/taskprocessing/task/{task_id}")
+			# rate limiting is handled by the shared poller
+			response = await task_poller.poll(nc, task_id, delay)
 		except (
 				ConnectionError,
 				Timeout
 		) as e:
 			await log(nc, LogLvl.DEBUG, "Ignored error during task polling")
-			await asyncio.sleep(wait_time)
 			raise
 		except NextcloudException as e:
-			if e.status_code == 429:
-				await log(nc, LogLvl.INFO, "Rate limited during task polling, waiting 10s more")
-				await asyncio.sleep(10)
-				raise
 			raise Exception("Nextcloud error when polling task") from e
 
 		try:
@@ -228,6 +379,26 @@ class ChatWithNextcloud(BaseChatModel):
 		except ValidationError as e:
 			raise Exception("Failed to parse Nextcloud TaskProcessing task result") from e
 
+	async def _cache_key(self, messages: list[BaseMessage], task_input: dict[str, typing.Any]) -> str | None:
+		"""The key of the request in the response cache, None if it must not be answered from the cache"""
+		if not llm_cache.enabled:
+			return None
+		last_message = messages[-1] if messages else None
+		if last_message is not None and last_message.type == 'tool' and last_message.name in self.cache_bypass_tools:
+			return None
+		return llm_cache.key(await self.nc.user, self._task_type(), task_input)
+
+	def _cache_response(self, key: str | None, task: Task):
+		if key is None or task.status != "STATUS_SUCCESSFUL":
+			return
+		tool_calls, _ = self._task_tool_calls(task)
+		if any(tool_call['name'] in self.cache_bypass_tools for tool_call in tool_calls):
+			return
+		llm_cache.put(key, task)
+
+	def _task_type(self) -> str:
+		return MULTIMODAL_CHAT_WITH_TOOLS if self.multimodal else TEXT_CHAT_WITH_TOOLS
+
 	def _task_output_text(self, task: Task) -> str | None:
 		if not isinstance(task.output, dict):
 			return None
@@ -306,6 +477,7 @@ class ChatWithNextcloud(BaseChatModel):
 			return current_output[len(streamed_output):]
 		return current_output
 
+	@traced("llm.generate")
 	async def _agenerate(
 			self,
 			messages: list[BaseMessage],
@@ -314,24 +486,25 @@ class ChatWithNextcloud(BaseChatModel):
 			**kwargs: Any,
 	) -> ChatResult:
 		task_input = self._build_task_input(messages)
-		task = await self._schedule_task(task_input)
-
-		i = 0
-		wait_time = self.POLL_WAIT_TIME
-		# wait for TIMEOUT (one i ^= wait_time sec)
-		while task.status != "STATUS_SUCCESSFUL" and task.status != "STATUS_FAILED" and i < self.TIMEOUT / wait_time:
-			await asyncio.sleep(wait_time)
-			i += 1
+		started_at = monotonic()
+		cache_key = await self._cache_key(messages, task_input)
+		task = llm_cache.get(cache_key) if cache_key is not None else None
+		if task is not None:
+			LLM_CACHE_HITS.inc(task_type=self._task_type())
+		else:
+			task = await self._schedule_task(task_input)
+
+		schedule = PollSchedule(self.POLL_INITIAL_WAIT_TIME, self.POLL_WAIT_TIME)
+		deadline = monotonic() + self.TIMEOUT
+		while task.status != "STATUS_SUCCESSFUL" and task.status != "STATUS_FAILED" and monotonic() < deadline:
 			try:
-				task = await self._poll_task(task.id, wait_time)
+				task = await self._poll_task(task.id, schedule.next_interval(task.completionExpectedAt))
 			except (ConnectionError, Timeout):
-				i += 1
 				continue
-			except NextcloudException as e:
-				if e.status_code == 429:
-					i += 2
-					continue
-				raise
+
+		if task.status in ("STATUS_SUCCESSFUL", "STATUS_FAILED"):
+			untrack_scheduled_task(task.id)
+		LLM_WAIT_SECONDS.observe(monotonic() - started_at, task_type=self._task_type())
 
 		if task.status == "STATUS_FAILED":
 			raise Exception("Nextcloud TaskProcessing Task failed")
@@ -340,8 +513,10 @@ class ChatWithNextcloud(BaseChatModel):
 			raise Exception("Nextcloud TaskProcessing Task timed out")
 
 		message = self._task_to_message(task)
+		self._cache_response(cache_key, task)
 		return ChatResult(generations=[ChatGeneration(message=message)])
 
+	@traced("llm.stream")
 	async def _astream(
 			self,
 			messages: list[BaseMessage],
@@ -349,27 +524,26 @@ class ChatWithNextcloud(BaseChatModel):
 			**kwargs: Any,
 	) -> AsyncIterator[ChatGenerationChunk]:
 		task_input = self._build_task_input(messages)
-		task = await self._schedule_task(task_input, prefer_streaming=True)
+		started_at = monotonic()
+		cache_key = await self._cache_key(messages, task_input)
+		task = llm_cache.get(cache_key) if cache_key is not None else None
+		if task is not None:
+			# the polling below is skipped and the whole output is sent as one chunk
+			LLM_CACHE_HITS.inc(task_type=self._task_type())
+		else:
+			task = await self._schedule_task(task_input, prefer_streaming=True)
 
 		streamed_output = ''
 		streaming_supported = False
 		yielded_chunk = False
-		i = 0
-		wait_time = self.STREAMING_POLL_WAIT_TIME
+		schedule = PollSchedule(self.POLL_INITIAL_WAIT_TIME, self.STREAMING_POLL_WAIT_TIME)
+		deadline = monotonic() + self.TIMEOUT
 
-		while task.status not in ("STATUS_SUCCESSFUL", "STATUS_FAILED") and i < self.TIMEOUT / wait_time:
-			await asyncio.sleep(wait_time)
-			i += 1
+		while task.status not in ("STATUS_SUCCESSFUL", "STATUS_FAILED") and monotonic() < deadline:
 			try:
-				task = await self._poll_task(task.id, wait_time)
+				task = await self._poll_task(task.id, schedule.next_interval(task.completionExpectedAt))
 			except (ConnectionError, Timeout):
-				i += 1
 				continue
-			except NextcloudException as e:
-				if e.status_code == 429:
-					i += 10
-					continue
-				raise
 
 			current_output = self._task_output_text(task)
 			if task.status == "STATUS_RUNNING" and current_output is not None:
@@ -380,6 +554,10 @@ class ChatWithNextcloud(BaseChatModel):
 					yield ChatGenerationChunk(message=AIMessageChunk(content=delta))
 				streamed_output = current_output
 
+		if task.status in ("STATUS_SUCCESSFUL", "STATUS_FAILED"):
+			untrack_scheduled_task(task.id)
+		LLM_WAIT_SECONDS.observe(monotonic() - started_at, task_type=self._task_type())
+
 		if task.status == "STATUS_FAILED":
 			raise Exception("Nextcloud TaskProcessing Task failed")
 
@@ -389,6 +567,7 @@ class ChatWithNextcloud(BaseChatModel):
 		final_output = self._task_output_text(task)
 		if final_output is None:
 			raise Exception('"output" key not found in Nextcloud TaskProcessing task result')
+		self._cache_response(cache_key, task)
 
 		if not streaming_supported:
 			if final_output:
@@ -429,12 +608,18 @@ class ChatWithNextcloud(BaseChatModel):
 			],
 			**kwargs: Any,
 	) -> Runnable[LanguageModelInput, BaseMessage]:
-		self.tools = [convert_to_openai_tool(tool) for tool in tools]
-		return self
+		# a copy, so that concurrent tasks can bind different tools to the same base model
+		schemas, tools_json = convert_tools(tools)
+		return self.model_copy(update={"tools": schemas, "tools_json": tools_json})
 
 	def bind_nextcloud(self,
-					   nc: AsyncNextcloudApp):
-		self.nc = nc
+					   nc: AsyncNextcloudApp,
+					   multimodal: bool | None = None) -> 'ChatWithNextcloud':
+		"""Return a copy of the model that schedules its tasks with the given Nextcloud session"""
+		update: dict[str, Any] = {"nc": nc}
+		if multimodal is not None:
+			update["multimodal"] = multimodal
+		return self.model_copy(update=update)
 
 	def _llm_type(self) -> str:
 		return "nextcloud-context-agent"
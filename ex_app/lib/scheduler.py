@@ -0,0 +1,266 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import random
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable
+from time import monotonic
+from typing import Any
+
+from ex_app.lib.metrics import REACT_SECONDS, TASK_CLAIM_SECONDS, TASK_CLAIM_TO_START_SECONDS
+
+
+class TaskScheduler:
+	"""
+	Bounded worker pool for claimed TaskProcessing tasks
+
+	At most `max_running` tasks run at the same time. Claimed tasks that cannot start right
+	away wait in a per-user queue, and the queues are served round-robin whenever a slot frees
+	up. Users with fewer than `max_per_user` running tasks go first, so one user with many
+	scheduled assignments cannot starve everyone else. A user above that limit only gets
+	slots that would otherwise sit idle.
+
+	By default the ready queue is sized to the free slots. With `prefetch`, the claim loop
+	keeps up to that many tasks (and at most `max_queued`) more than there are free slots,
+	so that a slot that frees up can start the next task without waiting for a round trip
+	to Nextcloud. Those tasks are held back from other replicas, so it is off by default.
+
+	When draining, no new tasks are claimed. Queued tasks still start as slots free up, the
+	ones that haven't started by the drain deadline are rejected.
+	"""
+
+	def __init__(self, max_running: int, max_per_user: int, max_queued: int, prefetch: int = 0):
+		self.max_running = max(1, max_running)
+		self.max_per_user = max(1, max_per_user)
+		self.max_queued = max(1, max_queued)
+		self.prefetch = max(0, prefetch)
+		self._running_per_user: defaultdict[str, int] = defaultdict(int)
+		# dicts keep insertion order, which is the round-robin order of the users
+		self._queues: dict[str, deque[tuple[float, Callable[[], Awaitable[Any]], Callable[[], Awaitable[Any]] | None]]] = {}
+		self._tasks: set[asyncio.Task] = set()
+		self._changed = asyncio.Condition()
+		self.draining = False
+
+	@property
+	def running(self) -> int:
+		return sum(self._running_per_user.values())
+
+	@property
+	def queue_depth(self) -> int:
+		return sum(len(queue) for queue in self._queues.values())
+
+	def can_claim(self) -> bool:
+		"""Whether the claim loop may fetch another task from Nextcloud"""
+		if self.draining or self.queue_depth >= self.max_queued:
+			return False
+		# tasks only wait in the queue while all slots are busy
+		return self.running + self.queue_depth < self.max_running + self.prefetch
+
+	async def wait_for_capacity(self):
+		"""Block until a new task can be claimed"""
+		async with self._changed:
+			await self._changed.wait_for(self.can_claim)
+
+	def submit(
+			self,
+			user_id: str | None,
+			run: Callable[[], Awaitable[Any]],
+			reject: Callable[[], Awaitable[Any]] | None = None,
+	):
+		"""
+		Queue a claimed task and start it as soon as the limits allow
+
+		:param user_id: The user the task belongs to, used for fairness
+		:param run: A coroutine function carrying out the task
+		:param reject: A coroutine function reporting the task as failed if a drain ends before it started
+		"""
+		self._queues.setdefault(user_id or '', deque()).append((monotonic(), run, reject))
+		self._dispatch()
+
+	async def drain(self, timeout: float) -> int:
+		"""
+		Stop claiming and wait for the claimed tasks to finish
+
+		:param timeout: Seconds to wait before the remaining tasks get cancelled
+		:return: The number of cancelled and rejected tasks
+		"""
+		self.draining = True
+		deadline = monotonic() + timeout
+		# queued tasks are started by _run as the running ones finish
+		while self._tasks and monotonic() < deadline:
+			await asyncio.wait(set(self._tasks), timeout=deadline - monotonic())
+		queued = [item for queue in self._queues.values() for item in queue]
+		self._queues.clear()
+		pending = set(self._tasks)
+		for task in pending:
+			task.cancel()
+		# give the cancelled and rejected tasks a moment to report their error to Nextcloud
+		pending |= {asyncio.create_task(reject()) for _, _, reject in queued if reject is not None}
+		if pending:
+			await asyncio.wait(pending, timeout=5)
+		return len(pending)
+
+	async def resume(self):
+		"""Allow claiming again after a drain"""
+		if not self.draining:
+			return
+		self.draining = False
+		async with self._changed:
+			self._changed.notify_all()
+
+	def stats(self) -> dict[str, Any]:
+		return {
+			'draining': self.draining,
+			'running': self.running,
+			'queued': self.queue_depth,
+			'max_running': self.max_running,
+			'max_per_user': self.max_per_user,
+			'users': len(self._running_per_user.keys() | self._queues.keys()),
+			'claim_latency': TASK_CLAIM_SECONDS.summary(),
+			'queue_latency': TASK_CLAIM_TO_START_SECONDS.summary(),
+			'execution_latency': REACT_SECONDS.summary(),
+		}
+
+	def _next_user(self) -> str | None:
+		for user_id in self._queues:
+			if self._running_per_user.get(user_id, 0) < self.max_per_user:
+				return user_id
+		# all waiting users are at their limit, a free slot is better used by one of them than left idle
+		return next(iter(self._queues), None)
+
+	def _dispatch(self):
+		while self.running < self.max_running:
+			user_id = self._next_user()
+			if user_id is None:
+				return
+			queue = self._queues.pop(user_id)
+			submitted_at, run, _ = queue.popleft()
+			TASK_CLAIM_TO_START_SECONDS.observe(monotonic() - submitted_at)
+			if queue:
+				# re-insert at the end, so the other users go first next time
+				self._queues[user_id] = queue
+			self._running_per_user[user_id] += 1
+			task = asyncio.create_task(self._run(user_id, run))
+			self._tasks.add(task)
+			task.add_done_callback(self._tasks.discard)
+
+	async def _run(self, user_id: str, run: Callable[[], Awaitable[Any]]):
+		try:
+			await run()
+		finally:
+			self._running_per_user[user_id] -= 1
+			if self._running_per_user[user_id] <= 0:
+				del self._running_per_user[user_id]
+			self._dispatch()
+			async with self._changed:
+				self._changed.notify_all()
+
+
+class PollingScheduler:
+	"""
+	Decides how long the claim loop waits before asking Nextcloud for the next task
+
+	While tasks are in flight it polls every `busy_interval` seconds. When idle, it backs off
+	from `idle_interval` to `idle_max_interval`, or waits up to `trigger_interval` once
+	`trust_threshold` triggers in a row have announced a task (triggers are available starting
+	with Nextcloud 33). If a task shows up that no trigger announced, triggers are considered
+	lost and fast idle polling resumes until they have proven themselves again.
+	Errors back off exponentially from `error_interval` to `error_max_interval`.
+	Every wait gets some jitter and returns early when a trigger arrives.
+	"""
+
+	def __init__(
+			self,
+			busy_interval: float = 2,
+			idle_interval: float = 2,
+			idle_max_interval: float = 10,
+			trigger_interval: float = 60,
+			trust_threshold: int = 3,
+			error_interval: float = 5,
+			error_max_interval: float = 60,
+			backoff_factor: float = 1.5,
+			jitter: float = 0.2,
+	):
+		self.busy_interval = busy_interval
+		self.idle_interval = idle_interval
+		self.idle_max_interval = idle_max_interval
+		self.trigger_interval = trigger_interval
+		self.trust_threshold = max(1, trust_threshold)
+		self.error_interval = error_interval
+		self.error_max_interval = error_max_interval
+		self.backoff_factor = backoff_factor
+		self.jitter = jitter
+		self.trigger = asyncio.Event()
+		self.triggers_trusted = False
+		self.empty_polls = 0
+		self.errors = 0
+		self.triggers_received = 0
+		self.triggers_lost = 0
+		# triggers in a row that were followed by a task
+		self.triggers_confirmed = 0
+		self.last_interval = 0.0
+		self._relied_on_trigger = False
+		self._woken_by_trigger = False
+
+	def on_trigger(self):
+		"""Called when Nextcloud announces a new task"""
+		self.triggers_received += 1
+		self.trigger.set()
+
+	def on_task_claimed(self):
+		if self._relied_on_trigger and not self._woken_by_trigger:
+			# we slept long on the promise of a trigger, but found a task that wasn't announced
+			self.triggers_lost += 1
+			self.triggers_confirmed = 0
+			self.triggers_trusted = False
+		elif self._woken_by_trigger:
+			self.triggers_confirmed += 1
+			if self.triggers_confirmed >= self.trust_threshold:
+				self.triggers_trusted = True
+		self._relied_on_trigger = False
+		# the following claims without a wait in between were not announced by this trigger
+		self._woken_by_trigger = False
+		self.empty_polls = 0
+		self.errors = 0
+
+	async def wait_idle(self, busy: bool):
+		"""Wait after a poll that returned no task"""
+		self.errors = 0
+		self._relied_on_trigger = not busy and self.triggers_trusted
+		if busy:
+			interval = self.busy_interval
+		elif self._relied_on_trigger:
+			interval = self.trigger_interval
+		else:
+			interval = min(self.idle_interval * self.backoff_factor ** self.empty_polls, self.idle_max_interval)
+		self.empty_polls += 1
+		await self._wait(interval)
+
+	async def wait_after_error(self):
+		"""Wait after a failed poll"""
+		interval = min(self.error_interval * 2 ** self.errors, self.error_max_interval)
+		self.errors += 1
+		self._relied_on_trigger = False
+		await self._wait(interval)
+
+	def state(self) -> dict[str, Any]:
+		return {
+			'triggers_trusted': self.triggers_trusted,
+			'triggers_received': self.triggers_received,
+			'triggers_lost': self.triggers_lost,
+			'triggers_confirmed': self.triggers_confirmed,
+			'empty_polls': self.empty_polls,
+			'errors': self.errors,
+			'last_interval': round(self.last_interval, 3),
+		}
+
+	async def _wait(self, interval: float):
+		interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+		self.last_interval = interval
+		self._woken_by_trigger = False
+		try:
+			await asyncio.wait_for(self.trigger.wait(), timeout=interval)
+			self._woken_by_trigger = True
+		except asyncio.TimeoutError:
+			pass
+		self.trigger.clear()
@@ -1,6 +1,11 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import hashlib
+import hmac
+
+# length of the legacy SHA-512 hex signature in front of the signed string
+LEGACY_SIGNATURE_LENGTH = 128
+
 
 def create_hash(input_string: str, key: str):
 	"""
@@ -10,11 +15,9 @@ def create_hash(input_string: str, key: str):
 	:param key: the key to add to the hash
 	:return: The SHA-512 hash as a hexadecimal string
 	"""
-	# Encode the input string and key to bytes
-	encoded_string = (input_string + key).encode('utf-8')
-
-	# Create a SHA-512 hash object
-	sha512_hash = hashlib.sha512(encoded_string)
+	# hash the input string and then the key, without building their concatenation
+	sha512_hash = hashlib.sha512(input_string.encode('utf-8'))
+	sha512_hash.update(key.encode('utf-8'))
 
 	# Return the hexadecimal representation of the hash
 	return sha512_hash.hexdigest()
@@ -23,8 +26,40 @@ def add_signature(input_string: str, key: str):
 	return create_hash(input_string, key) + input_string
 
 def verify_signature(input_string: str, key: str):
-	original_hash = input_string[:128]
-	created_hash = create_hash(input_string[128:], key)
-	if original_hash != created_hash:
+	"""Verify a legacy SHA-512 signature and return the signed string"""
+	signed_string = input_string[LEGACY_SIGNATURE_LENGTH:]
+	original_hash = input_string[:LEGACY_SIGNATURE_LENGTH].encode('utf-8')
+	if not hmac.compare_digest(original_hash, create_hash(signed_string, key).encode('ascii')):
 		raise Exception("Signature verification failed")
-	return input_string[128:]
\ No newline at end of file
+	return signed_string
+
+
+def sign(data: bytes | memoryview, key: bytes) -> bytes:
+	"""HMAC-SHA256 of the data, computed on the buffer as it is"""
+	return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def verify(data: bytes | memoryview, signature: bytes | memoryview, key: bytes):
+	if not hmac.compare_digest(bytes(signature), sign(data, key)):
+		raise Exception("Signature verification failed")
+
+
+if __name__ == '__main__':
+	# micro-benchmark: python -m ex_app.lib.signature
+	import os
+	import timeit
+
+	benchmark_key = os.urandom(128).hex()
+	for size in (1024 * 1024, 10 * 1024 * 1024):
+		text = os.urandom(size // 2).hex()
+		data = text.encode('ascii')
+		token = add_signature(text, benchmark_key)
+		signature = sign(data, benchmark_key.encode())
+		runs = 20
+		results = {
+			'legacy sign': timeit.timeit(lambda: add_signature(text, benchmark_key), number=runs),
+			'legacy verify': timeit.timeit(lambda: verify_signature(token, benchmark_key), number=runs),
+			'hmac sign': timeit.timeit(lambda: sign(memoryview(data), benchmark_key.encode()), number=runs),
+			'hmac verify': timeit.timeit(lambda: verify(memoryview(data), signature, benchmark_key.encode()), number=runs),
+		}
+		print(f"{size // (1024 * 1024)} MB: " + ", ".join(f"{name} {seconds / runs * 1000:.2f} ms" for name, seconds in results.items()))
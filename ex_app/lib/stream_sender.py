@@ -0,0 +1,73 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import os
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+# minimum seconds between two stream-result updates of the same task
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", "0.5"))
+
+
+class StreamSender:
+	"""
+	Sends intermediate task results from a separate coroutine
+
+	update() only stores the newest state and returns right away. The sender posts at most one
+	update per `interval` seconds and always the newest state, so updates that arrive while a
+	request is in flight replace each other instead of queueing up behind it.
+	"""
+
+	def __init__(self, send: Callable[[dict[str, Any]], Awaitable[None]], interval: float = STREAM_UPDATE_INTERVAL):
+		self.send = send
+		self.interval = interval
+		self.latest: dict[str, Any] | None = None
+		self.sent: dict[str, Any] | None = None
+		self._pending = asyncio.Event()
+		self._urgent = asyncio.Event()
+		self._closed = False
+		self._task = asyncio.create_task(self._run())
+
+	def update(self, state: dict[str, Any], urgent: bool = False):
+		"""
+		Replace the state to send
+
+		:param urgent: Send without waiting for the rest of the interval
+		"""
+		self.latest = state
+		self._pending.set()
+		if urgent:
+			self._urgent.set()
+
+	async def close(self, timeout: float = 10):
+		"""Send the newest state, if it hasn't been sent yet, and stop"""
+		self._closed = True
+		self._pending.set()
+		self._urgent.set()
+		try:
+			await asyncio.wait_for(self._task, timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	def cancel(self):
+		self._task.cancel()
+
+	async def _run(self):
+		while True:
+			await self._pending.wait()
+			self._pending.clear()
+			self._urgent.clear()
+			state = self.latest
+			if state is not None and state != self.sent:
+				try:
+					await self.send(state)
+				except Exception:
+					# streaming is best effort, the final result is reported separately
+					return
+				self.sent = state
+			if self._closed and not self._pending.is_set():
+				return
+			try:
+				await asyncio.wait_for(self._urgent.wait(), timeout=self.interval)
+			except asyncio.TimeoutError:
+				pass
@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import hashlib
+import os
+import re
+import time
+from typing import Any
+
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import tool
+from nc_py_api.ex_app import persistent_storage
+
+from ex_app.lib.all_tools.lib.decorator import safe_tool
+
+# tool outputs longer than this many characters are stored and replaced by a preview in the history
+TOOL_OUTPUT_INLINE_LIMIT = int(os.getenv("TOOL_OUTPUT_INLINE_LIMIT", "4000"))
+TOOL_OUTPUT_PREVIEW_LENGTH = 1000
+# stored outputs that haven't been written or read for this many days are removed
+TOOL_OUTPUT_MAX_AGE_DAYS = int(os.getenv("TOOL_OUTPUT_MAX_AGE_DAYS", "30"))
+CLEANUP_INTERVAL = 60 * 60
+
+HANDLE_PREFIX = "tool-output:"
+READ_TOOL_NAME = "read_tool_output"
+HANDLE_PATTERN = re.compile(r"^tool-output:([0-9a-f]{64})$")
+
+_last_cleanup = 0.0
+
+
+def _store_dir() -> str:
+	return os.path.join(persistent_storage(), "tool_outputs")
+
+
+class ToolOutputStore:
+	"""
+	Content-addressed storage of large tool outputs of one user
+
+	The history only keeps a preview and a handle of such an output, the model can page through
+	the rest with the read_tool_output tool. The handles are derived from the user id as well,
+	so that they can't be used to read the outputs of another user.
+	"""
+
+	def __init__(self, user_id: str):
+		self.user_id = user_id
+		self.directory = os.path.join(_store_dir(), hashlib.sha256(user_id.encode()).hexdigest()[:32])
+
+	def _path(self, digest: str) -> str:
+		return os.path.join(self.directory, digest + ".txt")
+
+	def store(self, content: str) -> str:
+		digest = hashlib.sha256(f"{self.user_id}\0{content}".encode()).hexdigest()
+		path = self._path(digest)
+		if os.path.exists(path):
+			os.utime(path)
+		else:
+			os.makedirs(self.directory, exist_ok=True)
+			tmp_path = f"{path}.{os.getpid()}.tmp"
+			with open(tmp_path, "w", encoding="utf-8") as file:
+				file.write(content)
+			os.replace(tmp_path, path)
+		_cleanup()
+		return HANDLE_PREFIX + digest
+
+	def read(self, handle: str, offset: int = 0, length: int = TOOL_OUTPUT_INLINE_LIMIT) -> str:
+		match = HANDLE_PATTERN.match(handle.strip())
+		if match is None:
+			raise ValueError(f"Invalid tool output handle: {handle}")
+		path = self._path(match.group(1))
+		try:
+			with open(path, "r", encoding="utf-8") as file:
+				content = file.read()
+		except FileNotFoundError:
+			raise ValueError(f"The tool output {handle} is not available anymore, call the original tool again")
+		os.utime(path)
+		offset = max(0, offset)
+		length = max(1, min(length, TOOL_OUTPUT_INLINE_LIMIT))
+		chunk = content[offset:offset + length]
+		end = offset + len(chunk)
+		remaining = f"{len(content) - end} characters remaining, continue at offset {end}." if end < len(content) else "End of output."
+		return f"[characters {offset}-{end} of {len(content)}]\n{chunk}\n[{remaining}]"
+
+	def offload(self, message: Any) -> Any:
+		"""Replace the content of a large tool message by a preview and a handle"""
+		if not isinstance(message, ToolMessage) or not isinstance(message.content, str):
+			return message
+		if message.name == READ_TOOL_NAME:
+			# already a page of a stored output, offloading it again would cut off its position
+			return message
+		content = message.content
+		if len(content) <= TOOL_OUTPUT_INLINE_LIMIT:
+			return message
+		handle = self.store(content)
+		preview = content[:TOOL_OUTPUT_PREVIEW_LENGTH]
+		return message.model_copy(update={"content": (
+			f"{preview}…\n[Output truncated, showing {len(preview)} of {len(content)} characters."
+			f" Use the read_tool_output tool with handle \"{handle}\" and an offset to read the rest.]"
+		)})
+
+	def offload_messages(self, output: Any) -> Any:
+		"""Offload the large tool messages in the output of a tool node"""
+		if isinstance(output, dict) and "messages" in output:
+			return {**output, "messages": [self.offload(message) for message in output["messages"]]}
+		if isinstance(output, list):
+			return [self.offload(message) for message in output]
+		return output
+
+	def get_tools(self):
+		@tool
+		@safe_tool
+		async def read_tool_output(handle: str, offset: int = 0, length: int = TOOL_OUTPUT_INLINE_LIMIT) -> str:
+			"""
+			Read a part of a long tool output that was truncated in the conversation
+			:param handle: The handle given in place of the full output, e.g. "tool-output:3f2a…"
+			:param offset: The character to start reading at
+			:param length: The number of characters to read
+			:return: The requested part of the output
+			"""
+			return self.read(handle, offset, length)
+
+		return [read_tool_output]
+
+
+def _cleanup():
+	"""Remove the stored outputs that haven't been used for a while, at most once per interval"""
+	global _last_cleanup
+	now = time.time()
+	if now - _last_cleanup < CLEANUP_INTERVAL:
+		return
+	_last_cleanup = now
+	max_age = TOOL_OUTPUT_MAX_AGE_DAYS * 24 * 60 * 60
+	for root, _, files in os.walk(_store_dir()):
+		for name in files:
+			path = os.path.join(root, name)
+			try:
+				if now - os.path.getmtime(path) > max_age:
+					os.remove(path)
+			except OSError:
+				pass
@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Sequence
+
+from langchain_core.messages import BaseMessage
+from langchain_core.tools import BaseTool
+
+from ex_app.lib.nc_model import extract_text_content
+
+# number of tools sent to the model per turn, in addition to the always-on ones, 0 sends all tools
+TOOL_SELECTION_TOP_K = int(os.getenv("TOOL_SELECTION_TOP_K", "0"))
+# number of recent messages that are matched against the tools besides the user input
+QUERY_HISTORY_MESSAGES = 4
+QUERY_MESSAGE_MAX_LENGTH = 1000
+INDEX_CACHE_SIZE = 32
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r"[^\W_]{2,}")
+
+_index_cache: OrderedDict[tuple, 'ToolIndex'] = OrderedDict()
+
+
+def tokenize(text: str) -> list[str]:
+	return TOKEN_PATTERN.findall(text.lower())
+
+
+class ToolIndex:
+	"""BM25 index over the names and descriptions of a toolset"""
+
+	def __init__(self, tools: Sequence[BaseTool]):
+		self.documents: list[Counter] = []
+		for tool in tools:
+			# the name counts twice, it is the most specific part
+			tokens = tokenize(tool.name.replace("_", " ")) * 2 + tokenize(tool.description or "")
+			self.documents.append(Counter(tokens))
+		self.lengths = [sum(document.values()) for document in self.documents]
+		self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+		document_frequency = Counter(token for document in self.documents for token in document)
+		count = len(self.documents)
+		self.idf = {
+			token: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+			for token, frequency in document_frequency.items()
+		}
+
+	def scores(self, query: Iterable[str]) -> list[float]:
+		query_tokens = [token for token in set(query) if token in self.idf]
+		scores = []
+		for document, length in zip(self.documents, self.lengths):
+			score = 0.0
+			for token in query_tokens:
+				frequency = document.get(token, 0)
+				if frequency:
+					norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.average_length)
+					score += self.idf[token] * frequency * (BM25_K1 + 1) / (frequency + norm)
+			scores.append(score)
+		return scores
+
+
+def get_index(tools: Sequence[BaseTool]) -> ToolIndex:
+	"""The index of a toolset, built once per set of tool names and descriptions"""
+	key = tuple((tool.name, tool.description) for tool in tools)
+	index = _index_cache.get(key)
+	if index is None:
+		index = ToolIndex(tools)
+		_index_cache[key] = index
+		if len(_index_cache) > INDEX_CACHE_SIZE:
+			_index_cache.popitem(last=False)
+	else:
+		_index_cache.move_to_end(key)
+	return index
+
+
+class ToolSelector:
+	"""
+	Picks the tools that are sent to the model for a turn
+
+	The tools are ranked against the user input and the recent history. Tools that were called
+	earlier in the conversation and the always-on tools are always sent. When the model asks for
+	a tool that was left out, that tool is sent from then on, and when it asks for a tool that
+	doesn't exist, the selection grows and the requested name is matched as well.
+	"""
+
+	def __init__(self, tools: Sequence[BaseTool], top_k: int = TOOL_SELECTION_TOP_K, always: Iterable[str] = ()):
+		self.tools = list(tools)
+		self.top_k = top_k
+		self.initial_top_k = top_k
+		self.always = set(always)
+		self.known = {tool.name for tool in self.tools}
+		self.widened: set[str] = set()
+		self.unknown: set[str] = set()
+		self.extra_query: list[str] = []
+
+	def select(self, messages: Sequence[BaseMessage]) -> list[BaseTool]:
+		if self.top_k <= 0 or self.top_k >= len(self.tools):
+			return self.tools
+		self._widen(messages)
+
+		query = list(self.extra_query)
+		for message in messages[-QUERY_HISTORY_MESSAGES:]:
+			query += tokenize(extract_text_content(message.content)[:QUERY_MESSAGE_MAX_LENGTH])
+		scores = get_index(self.tools).scores(query)
+		if not any(scores):
+			# nothing to go by, e.g. the user doesn't write in English
+			return self.tools
+
+		ranked = sorted(range(len(self.tools)), key=lambda i: scores[i], reverse=True)
+		selected = {self.tools[i].name for i in ranked[:self.top_k] if scores[i] > 0}
+		selected |= (self.always | self.widened) & self.known
+		return [tool for tool in self.tools if tool.name in selected]
+
+	def _widen(self, messages: Sequence[BaseMessage]):
+		for message in messages:
+			for tool_call in getattr(message, 'tool_calls', None) or []:
+				name = tool_call.get('name') or ''
+				if name in self.known:
+					self.widened.add(name)
+				elif name and name not in self.unknown:
+					# a tool that doesn't exist, the closest ones get a chance in the next turn
+					self.unknown.add(name)
+					self.extra_query += tokenize(name.replace("_", " "))
+					self.top_k += self.initial_top_k
@@ -0,0 +1,264 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import atexit
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from nc_py_api.ex_app import persistent_storage
+
+# share of the tasks that get traced, 0 disables tracing
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_FILE_COUNT = int(os.getenv("TRACE_FILE_COUNT", "5"))
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+	def __init__(self, trace: 'Trace', name: str, parent_id: str | None, attributes: dict[str, Any]):
+		self.trace = trace
+		self.name = name
+		self.span_id = os.urandom(8).hex()
+		self.parent_id = parent_id
+		self.attributes = attributes
+		self.start_time = time.time_ns()
+		self.end_time: int | None = None
+		self.error: str | None = None
+		trace.spans.append(self)
+
+	def child(self, name: str, **attributes: Any) -> 'Span':
+		return Span(self.trace, name, self.span_id, attributes)
+
+	def set_attribute(self, key: str, value: Any):
+		self.attributes[key] = value
+
+	def end(self, error: BaseException | None = None):
+		self.end_time = time.time_ns()
+		if error is not None:
+			self.error = repr(error)
+
+	def to_otlp(self) -> dict[str, Any]:
+		span = {
+			'traceId': self.trace.trace_id,
+			'spanId': self.span_id,
+			'name': self.name,
+			'kind': 1,
+			'startTimeUnixNano': str(self.start_time),
+			'endTimeUnixNano': str(self.end_time or time.time_ns()),
+			'attributes': [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+			'status': {'code': STATUS_ERROR, 'message': self.error} if self.error else {'code': STATUS_OK},
+		}
+		if self.parent_id:
+			span['parentSpanId'] = self.parent_id
+		return span
+
+
+class Trace:
+	def __init__(self):
+		self.trace_id = os.urandom(16).hex()
+		self.spans: list[Span] = []
+
+	def to_otlp(self) -> dict[str, Any]:
+		return {'resourceSpans': [{
+			'resource': {'attributes': [_otlp_attribute('service.name', os.getenv('APP_ID', 'context_agent'))]},
+			'scopeSpans': [{
+				'scope': {'name': 'context_agent'},
+				'spans': [span.to_otlp() for span in self.spans],
+			}],
+		}]}
+
+
+def _otlp_attribute(key: str, value: Any) -> dict[str, Any]:
+	if isinstance(value, bool):
+		return {'key': key, 'value': {'boolValue': value}}
+	if isinstance(value, int):
+		return {'key': key, 'value': {'intValue': str(value)}}
+	if isinstance(value, float):
+		return {'key': key, 'value': {'doubleValue': value}}
+	return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class _OtlpLine:
+	"""Serializes a finished trace when the record is formatted"""
+
+	def __init__(self, trace: Trace):
+		self.trace = trace
+
+	def __str__(self) -> str:
+		return json.dumps(self.trace.to_otlp())
+
+
+class _TraceQueueHandler(QueueHandler):
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		# formatted by the listener thread, so that large traces don't block the event loop
+		return record
+
+
+_current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+_exporter: logging.Logger | None = None
+
+
+def _export(trace: Trace):
+	"""Append the trace as one OTLP JSON line to rotating files in the persistent storage"""
+	global _exporter
+	if _exporter is None:
+		trace_dir = os.path.join(persistent_storage(), 'traces')
+		os.makedirs(trace_dir, exist_ok=True)
+		handler = RotatingFileHandler(
+			os.path.join(trace_dir, 'traces.jsonl'), maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_COUNT,
+		)
+		handler.setFormatter(logging.Formatter('%(message)s'))
+		records = queue.SimpleQueue()
+		listener = QueueListener(records, handler)
+		listener.start()
+		atexit.register(listener.stop)
+		_exporter = logging.getLogger('context_agent.traces')
+		_exporter.propagate = False
+		_exporter.addHandler(_TraceQueueHandler(records))
+		_exporter.setLevel(logging.INFO)
+	_exporter.info('%s', _OtlpLine(trace))
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span | None]:
+	"""Start a sampled trace with a root span, it is exported when the root span ends"""
+	if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+		yield None
+		return
+	trace = Trace()
+	try:
+		with _activate(Span(trace, name, None, attributes)) as root:
+			yield root
+	finally:
+		try:
+			_export(trace)
+		except Exception:
+			pass
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+	"""Record a span below the current one, does nothing when the current task is not traced"""
+	parent = _current_span.get()
+	if parent is None:
+		yield None
+		return
+	with _activate(parent.child(name, **attributes)) as child:
+		yield child
+
+
+@contextmanager
+def _activate(current: Span) -> Iterator[Span]:
+	token = _current_span.set(current)
+	try:
+		yield current
+	except BaseException as e:
+		current.end(e)
+		raise
+	else:
+		current.end()
+	finally:
+		_current_span.reset(token)
+
+
+def current_span() -> Span | None:
+	return _current_span.get()
+
+
+def traced(name: str):
+	"""Decorator recording a span for each call of an async function or async generator"""
+	def decorator(func):
+		if inspect.isasyncgenfunction(func):
+			@wraps(func)
+			async def generator_wrapper(*args, **kwargs):
+				parent = _current_span.get()
+				if parent is None:
+					async for item in func(*args, **kwargs):
+						yield item
+					return
+				# not made current, the consumer's context would see it between the items
+				child = parent.child(name)
+				error = None
+				try:
+					async for item in func(*args, **kwargs):
+						yield item
+				except BaseException as e:
+					error = e
+					raise
+				finally:
+					child.end(error)
+			return generator_wrapper
+
+		@wraps(func)
+		async def wrapper(*args, **kwargs):
+			with span(name):
+				return await func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+	"""Records a span for each graph node and tool call below the given parent span"""
+
+	run_inline = True
+
+	def __init__(self, parent: Span):
+		self.parent = parent
+		self.spans: dict[UUID, Span] = {}
+		self.parents: dict[UUID, UUID | None] = {}
+
+	def _parent_span(self, parent_run_id: UUID | None) -> Span:
+		while parent_run_id is not None:
+			if parent_run_id in self.spans:
+				return self.spans[parent_run_id]
+			parent_run_id = self.parents.get(parent_run_id)
+		return self.parent
+
+	def on_chain_start(self, serialized: dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None, metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+		self.parents[run_id] = parent_run_id
+		node = (metadata or {}).get('langgraph_node')
+		if node is not None and kwargs.get('name') == node:
+			self.spans[run_id] = self._parent_span(parent_run_id).child(f'node {node}')
+
+	def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+		self._end(run_id)
+
+	def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+		self._end(run_id, error)
+
+	def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> None:
+		self.parents[run_id] = parent_run_id
+		tool = (serialized or {}).get('name') or kwargs.get('name') or 'unknown'
+		self.spans[run_id] = self._parent_span(parent_run_id).child(f'tool {tool}', tool=tool)
+
+	def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+		self._end(run_id)
+
+	def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+		self._end(run_id, error)
+
+	def _end(self, run_id: UUID, error: BaseException | None = None):
+		self.parents.pop(run_id, None)
+		current = self.spans.pop(run_id, None)
+		if current is not None:
+			current.end(error)
+
+
+def tracing_callbacks() -> list[BaseCallbackHandler]:
+	"""Callback handlers to pass to the graph, empty when the current task is not traced"""
+	parent = _current_span.get()
+	return [TracingCallbackHandler(parent)] if parent is not None else []
@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+from collections.abc import Coroutine
+from typing import Any
+
+from nc_py_api import AsyncNextcloudApp, NextcloudException
+from nc_py_api.ex_app import LogLvl
+
+from ex_app.lib.all_tools.lib.task_processing import cancel_tasks, scheduled_task_ids
+from ex_app.lib.logger import log
+
+
+class TaskCancelled(Exception):
+	pass
+
+
+class TaskWatchdog:
+	"""
+	Stops an agent run once its task was cancelled or deleted in Nextcloud
+
+	The task status is checked every `interval` seconds, or right away after `check_now()`,
+	e.g. when posting a stream update failed. When the run ends, for whatever reason, the
+	TaskProcessing tasks it scheduled and that are still unfinished get cancelled.
+	"""
+
+	def __init__(self, nc: AsyncNextcloudApp, task_id: int, interval: float | None):
+		self.nc = nc
+		self.task_id = task_id
+		self.interval = interval
+		self.cancelled = False
+		self._check_now = asyncio.Event()
+
+	def check_now(self):
+		self._check_now.set()
+
+	async def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+		"""
+		Run the coroutine until it finishes or the task gets cancelled
+
+		:raises TaskCancelled: if the task was cancelled in Nextcloud
+		"""
+		sub_task_ids: set[int] = set()
+		token = scheduled_task_ids.set(sub_task_ids)
+		try:
+			# the new task copies the current context, including the set of sub-tasks
+			work = asyncio.create_task(coro)
+		finally:
+			scheduled_task_ids.reset(token)
+		watcher = asyncio.create_task(self._watch(work)) if self.interval else None
+		try:
+			return await work
+		except asyncio.CancelledError:
+			if self.cancelled and not asyncio.current_task().cancelling():
+				raise TaskCancelled(f"Task {self.task_id} was cancelled in Nextcloud") from None
+			raise
+		finally:
+			if watcher is not None:
+				watcher.cancel()
+			# left over by a failed or cancelled run, nobody is going to wait for them
+			if sub_task_ids:
+				await cancel_tasks(self.nc, sub_task_ids)
+
+	async def _watch(self, work: asyncio.Task):
+		while not work.done():
+			try:
+				await asyncio.wait_for(self._check_now.wait(), timeout=self.interval)
+			except asyncio.TimeoutError:
+				pass
+			self._check_now.clear()
+			if await self._is_cancelled():
+				await log(self.nc, LogLvl.INFO, f"Task {self.task_id} was cancelled in Nextcloud, stopping")
+				self.cancelled = True
+				work.cancel()
+				return
+
+	async def _is_cancelled(self) -> bool:
+		try:
+			response = await self.nc.ocs("GET", f"/ocs/v2.php/taskprocessing/task/{self.task_id}")
+		except NextcloudException as e:
+			# the task was deleted
+			return e.status_code == 404
+		except Exception:
+			return False
+		return response.get('task', {}).get('status') == 'STATUS_CANCELLED'
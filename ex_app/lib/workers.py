@@ -0,0 +1,95 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import Callable
+from time import monotonic
+
+from ex_app.lib.logger import logger
+
+# spawn instead of fork: the parent already runs an event loop and several threads
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class WorkerSupervisor:
+	"""
+	Runs the task loop in several worker processes
+
+	The FastAPI and MCP app stay in the parent process, each worker runs its own
+	task loop with its own event loop. The enabled state is shared through a
+	multiprocessing event and every worker gets its own trigger event and a file
+	to publish its metrics to.
+	"""
+
+	def __init__(self, target: Callable, num_workers: int, enabled):
+		self.target = target
+		self.num_workers = num_workers
+		self.enabled = enabled
+		self.triggers = [MP_CONTEXT.Event() for _ in range(num_workers)]
+		self.processes: list[multiprocessing.Process | None] = [None] * num_workers
+		self.metrics_dir = tempfile.mkdtemp(prefix="context_agent-metrics-")
+		self.metrics_paths = [os.path.join(self.metrics_dir, f"worker-{index}.json") for index in range(num_workers)]
+		self.stopping = False
+
+	def _spawn(self, index: int):
+		try:
+			# the metrics of a dead worker are gone with it
+			os.remove(self.metrics_paths[index])
+		except FileNotFoundError:
+			pass
+		process = MP_CONTEXT.Process(
+			target=self.target,
+			args=(self.enabled, self.triggers[index], self.metrics_paths[index]),
+			name=f"context_agent-worker-{index}",
+			daemon=True,
+		)
+		process.start()
+		self.processes[index] = process
+		logger.info(f"Started worker process {process.name} (pid {process.pid})")
+
+	def start(self):
+		for index in range(self.num_workers):
+			self._spawn(index)
+
+	def trigger(self):
+		for trigger in self.triggers:
+			trigger.set()
+
+	async def monitor(self, interval: float = 5):
+		"""Restart worker processes that died"""
+		while not self.stopping:
+			await asyncio.sleep(interval)
+			for index, process in enumerate(self.processes):
+				if self.stopping or process is None or process.is_alive():
+					continue
+				logger.warning(f"Worker process {process.name} exited with code {process.exitcode}, restarting it")
+				self._spawn(index)
+
+	def stop(self, timeout: float = 10):
+		"""Ask the workers to drain and kill the ones that are still alive after `timeout` seconds"""
+		self.stopping = True
+		for process in self.processes:
+			if process is not None and process.is_alive():
+				process.terminate()
+		deadline = monotonic() + timeout
+		for process in self.processes:
+			if process is not None:
+				process.join(max(0.0, deadline - monotonic()))
+				if process.is_alive():
+					process.kill()
+		shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+
+def forward_trigger(trigger, loop: asyncio.AbstractEventLoop, callback: Callable[[], None]):
+	"""Bridge a multiprocessing trigger event into a callback running on the worker's loop"""
+	def run():
+		while True:
+			trigger.wait()
+			trigger.clear()
+			loop.call_soon_threadsafe(callback)
+
+	threading.Thread(target=run, name="trigger-forwarder", daemon=True).start()